@@ -5,18 +5,34 @@ Script to check pybugz output and suggest assignment/CC for identified atoms.
 """
 
 import collections
+import csv
+import itertools
+import json
 import os
+import queue
 import re
 import subprocess
+import sys
+import threading
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
 
 import portage
 
 import portage.dep as dep
 
 Bug = collections.namedtuple('Bug', ['id', 'assignee', 'summary'])
+Suggestion = collections.namedtuple('Suggestion', ['bug', 'atom', 'maintainers', 'candidates'])
 bugz_line = re.compile('(\d+) (\S+) *(.*)')
 line_atom = re.compile('(\w+-\w+/\S+)')
+bare_atom = re.compile(r'^\s*[=~]?([A-Za-z0-9+_][\w+.-]*):\s')
+pkg_version = re.compile(r'-\d+(\.\d+)*[a-z]?(_(alpha|beta|pre|rc|p)\d*)*(-r\d+)?$')
 package_list = None
+name_index = None
+name_index_version = 1
+pipeline_done = object()
+bugzilla_url = 'https://bugs.gentoo.org'
 
 
 def get_bugz_output() -> tuple:
@@ -26,24 +42,207 @@ def get_bugz_output() -> tuple:
     :returns: pybugz bug list, each bug being a named tuple
     :rtype: tuple
     """
+    return tuple(iter_bugz_output())
+
+
+def iter_bugz_output():
+    """
+    Runs pybugz and yields each bug as a named tuple as soon as its line has been read.
+
+    :returns: generator of Bug named tuples
+    :rtype: generator
+    """
     cmd = "bugz --columns 500 search -a bug-wranglers@gentoo.org -s CONFIRMED -s IN_PROGRESS -s UNCONFIRMED"
-    output = subprocess.check_output(cmd.split())
+    process = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, universal_newlines=True)
+
+    with process:
+        yield from parse_bugz_lines(line.rstrip('\n') for line in process.stdout)
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
 
-    bug_list = []
 
-    for line in output.splitlines():
-        line = line.decode()
+def parse_bugz_lines(lines):
+    """
+    Parses pybugz bug list lines, yielding a named tuple for each bug line.
+
+    :param lines: iterable of decoded pybugz output lines
+    :type lines: iterable
+    :returns: generator of Bug named tuples
+    :rtype: generator
+    """
+    for line in lines:
         if not re.search('^\d+', line):
             # this is not a bug line
             continue
 
-        match = re.search('(\d+) (\S+) *(.*)', line)
+        match = bugz_line.search(line)
         if not match:
             raise RuntimeError('Unable to grep the line')
 
-        bug_list.append(Bug(id=match.group(1), assignee=match.group(2), summary=match.group(3)))
+        yield Bug(id=match.group(1), assignee=match.group(2), summary=match.group(3))
+
+
+def read_bug_dump(infile):
+    """
+    Reads a bug dump of id, assignee and summary records, yielding a named tuple for each bug.
+
+    The dump may be either CSV (with an optional 'id,assignee,summary' header) or NDJSON with one object per line;
+    the format is detected from the first non-empty line. Records are read lazily so arbitrarily large dumps can be
+    processed in constant memory.
+
+    :param infile: file handle or STDIN stream of bug records
+    :type infile: file
+    :returns: generator of Bug named tuples
+    :rtype: generator
+    """
+    lines = iter(infile)
+    for first in lines:
+        if first.strip():
+            break
+    else:
+        return
+
+    lines = itertools.chain([first], lines)
+
+    if first.lstrip().startswith('{'):
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield Bug(id=str(record['id']), assignee=record.get('assignee', ''), summary=record.get('summary', ''))
+    else:
+        for row in csv.reader(lines):
+            if not row or row[0] == 'id':
+                # blank line or header
+                continue
+            if len(row) < 3:
+                raise RuntimeError('Invalid bug record: %r' % row)
+            yield Bug(id=row[0], assignee=row[1], summary=','.join(row[2:]))
+
+
+def resolve_suggestion(suggestion: Suggestion) -> Suggestion:
+    """
+    Fills in the atom and maintainers of a suggestion which matched exactly one package.
+
+    :param suggestion: suggestion with candidates found for the bug summary
+    :type suggestion: Suggestion
+    :returns: suggestion with atom and maintainers set, or unchanged for unparsed or ambiguous bugs
+    :rtype: Suggestion
+    """
+    if len(suggestion.candidates) != 1:
+        return suggestion
+
+    atom = suggestion.candidates[0]
+    maintainers = get_maintainers(atom)
+    if len(maintainers) == 0:
+        maintainers = tuple(['maintainer-needed@gentoo.org'])
+
+    return suggestion._replace(atom=atom, maintainers=maintainers)
+
 
-    return tuple(bug_list)
+def suggest_bugs(bugs, workers: int = 4, ordered: bool = True, queue_size: int = 64):
+    """
+    Looks up the atom and maintainers for each bug, yielding results as they are found.
+
+    Bugs are passed through fetch, atom extraction and maintainer resolution stages, each running in its own
+    thread(s) and connected by bounded queues, so that reading metadata overlaps with fetching further bugs.
+
+    :param bugs: iterable of Bug named tuples
+    :type bugs: iterable
+    :param workers: number of maintainer resolution threads
+    :type workers: int
+    :param ordered: yield results in the order bugs were read rather than as they complete
+    :type ordered: bool
+    :param queue_size: maximum number of bugs waiting between stages
+    :type queue_size: int
+    :returns: generator of Suggestion named tuples, atom and maintainers being None for unparsed or ambiguous bugs
+    :rtype: generator
+    """
+    assert isinstance(workers, int) and workers > 0
+
+    fetched = queue.Queue(queue_size)
+    extracted = queue.Queue(queue_size)
+    resolved = queue.Queue(queue_size)
+
+    def fetch():
+        try:
+            for seq, bug in enumerate(bugs):
+                fetched.put((seq, bug))
+        except Exception as err:
+            resolved.put((None, err))
+        fetched.put(pipeline_done)
+
+    def extract():
+        while True:
+            item = fetched.get()
+            if item is pipeline_done:
+                break
+            seq, bug = item
+            try:
+                extracted.put((seq, Suggestion(bug, None, None, find_atom_candidates(bug.summary))))
+            except Exception as err:
+                resolved.put((seq, err))
+        for i in range(workers):
+            extracted.put(pipeline_done)
+
+    def resolve():
+        while True:
+            item = extracted.get()
+            if item is pipeline_done:
+                break
+            seq, suggestion = item
+            try:
+                resolved.put((seq, resolve_suggestion(suggestion)))
+            except Exception as err:
+                resolved.put((seq, err))
+        resolved.put(pipeline_done)
+
+    threads = [threading.Thread(target=fetch), threading.Thread(target=extract)]
+    threads += [threading.Thread(target=resolve) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    pending = {}
+    next_seq = 0
+    finished = 0
+
+    while finished < workers:
+        item = resolved.get()
+        if item is pipeline_done:
+            finished += 1
+            continue
+
+        seq, result = item
+        if isinstance(result, Exception):
+            raise result
+
+        if not ordered:
+            yield result
+            continue
+
+        pending[seq] = result
+        while next_seq in pending:
+            yield pending.pop(next_seq)
+            next_seq += 1
+
+
+def modify_command(bug_ids: list, maintainers: tuple) -> str:
+    """
+    Builds the pybugz command to assign bugs to given maintainers.
+
+    :param bug_ids: ids of bugs to modify
+    :type bug_ids: list
+    :param maintainers: maintainer emails, the first being the assignee
+    :type maintainers: tuple
+    :returns: pybugz command line
+    :rtype: str
+    """
+    cmd = 'bugz modify -a %s' % maintainers[0]
+    for cc in maintainers[1:]:
+        cmd += ' --add-cc %s' % cc
+    return '%s %s' % (cmd, ' '.join(bug_ids))
 
 
 def find_atom(summary: str) -> str or None:
@@ -52,39 +251,124 @@ def find_atom(summary: str) -> str or None:
 
     :param summary: bug summary line to search
     :type summary: str
-    :returns: unqualified package atom (CP)
+    :returns: unqualified package atom (CP), or None if no single package matches
     :rtype: str or None
     """
+    candidates = find_atom_candidates(summary)
+    if len(candidates) == 1:
+        return candidates[0]
+    return None
+
+
+def find_atom_candidates(summary: str) -> tuple:
+    """
+    Searches a bug summary line for package atoms it could refer to.
+
+    Fully qualified atoms are preferred; failing that, a leading bare package name (e.g. "foo-1.2: fails to build") is
+    resolved through the package name index, which may yield several candidates from different categories.
+
+    :param summary: bug summary line to search
+    :type summary: str
+    :returns: tuple of unqualified package atoms (CP), empty if nothing matched
+    :rtype: tuple
+    """
     assert isinstance(summary, str)
-    match = line_atom.search(summary)
 
-    try:
+    # check if we've listed all atoms yet and create the list if not
+    global package_list
+    if package_list is None:
+        package_list = frozenset(portage.portdb.cp_all())
+
+    match = line_atom.search(summary)
+    if match:
         atom = match.group(1)
-    except AttributeError:
+
+        if atom.endswith(':'):
+            atom = atom[:-1]
+
+        if dep.isvalidatom(atom) or dep.isvalidatom('='+atom):
+            if not dep.isjustname(atom):
+                atom = portage.getCPFromCPV(atom)
+
+            if atom in package_list:
+                return tuple([atom])
+
+    match = bare_atom.search(summary)
+    if not match:
         # we still dont' have an atom
-        return None
+        return tuple()
 
-    if atom.endswith(':'):
-        atom = atom[:-1]
+    global name_index
+    if name_index is None:
+        name_index = load_name_index(portage.portdb.porttrees[0])
 
-    if not dep.isvalidatom(atom):
-        # try prepending an '='
-        if not dep.isvalidatom('='+atom):
-            # it's not a valid atom
-            return None
+    name = match.group(1).lower()
+    try:
+        return name_index[name]
+    except KeyError:
+        return name_index.get(pkg_version.sub('', name), tuple())
 
-    if not dep.isjustname(atom):
-        atom = portage.getCPFromCPV(atom)
 
-    # check if we've listed all atoms yet and create the list if not
+def build_name_index(atoms) -> dict:
+    """
+    Builds an index from bare (lower-case) package name to the atoms carrying that name.
+
+    :param atoms: iterable of unqualified package atoms (CP)
+    :type atoms: iterable
+    :returns: dictionary of {name: (atom, ...)}
+    :rtype: dict
+    """
+    index = {}
+    for atom in atoms:
+        category, name = dep.catsplit(atom)
+        index.setdefault(name.lower(), []).append(atom)
+
+    return {name: tuple(sorted(candidates)) for name, candidates in index.items()}
+
+
+def load_name_index(portdir: str) -> dict:
+    """
+    Loads the package name index for a tree, rebuilding the on-disk cache if the tree has changed since it was built.
+
+    :param portdir: path to portage tree
+    :type portdir: str
+    :returns: dictionary of {name: (atom, ...)}
+    :rtype: dict
+    """
+    assert isinstance(portdir, str)
+
+    cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'check-bugs')
+    cache_path = os.path.join(cache_dir, 'name-index.json')
+
+    # the timestamp is updated on every sync; fall back to category directories for local trees
+    timestamp = os.path.join(portdir, 'metadata', 'timestamp.chk')
+    if os.path.exists(timestamp):
+        stamp = os.stat(timestamp).st_mtime
+    else:
+        stamp = max([os.stat(portdir).st_mtime] + [e.stat().st_mtime for e in os.scandir(portdir) if e.is_dir()])
+
+    try:
+        with open(cache_path, 'r') as cache:
+            cached = json.load(cache)
+        if cached['version'] == name_index_version and cached['portdir'] == portdir and cached['stamp'] == stamp:
+            return {name: tuple(candidates) for name, candidates in cached['index'].items()}
+    except (OSError, ValueError, KeyError):
+        pass
+
     global package_list
     if package_list is None:
-        package_list = portage.portdb.cp_all()
+        package_list = frozenset(portage.portdb.cp_all())
+    index = build_name_index(package_list)
 
-    if atom in package_list:
-        return atom
-    else:
-        return None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path + '.tmp', 'w') as cache:
+            json.dump({'version': name_index_version, 'portdir': portdir, 'stamp': stamp, 'index': index}, cache)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as err:
+        print('Warning: unable to write name index cache %s: %s' % (cache_path, err), file=sys.stderr)
+
+    return index
 
 
 def get_maintainers(atom: str, portdir: str = '/usr/portage') -> tuple:
@@ -117,47 +401,208 @@ def get_maintainers(atom: str, portdir: str = '/usr/portage') -> tuple:
     return tuple(maintainers)
 
 
+def group_assignments(suggestions, batch_size: int = 100):
+    """
+    Groups bugs sharing the same assignee and CC list into batches suitable for a single bulk modification.
+
+    :param suggestions: iterable of (bug_id, maintainers) tuples
+    :type suggestions: iterable
+    :param batch_size: maximum number of bugs per batch
+    :type batch_size: int
+    :returns: generator of (maintainers, [bug_id, ...]) tuples
+    :rtype: generator
+    """
+    assert isinstance(batch_size, int) and batch_size > 0
+
+    groups = collections.OrderedDict()
+    for bug_id, maintainers in suggestions:
+        groups.setdefault(tuple(maintainers), []).append(bug_id)
+
+    for maintainers, bug_ids in groups.items():
+        for i in range(0, len(bug_ids), batch_size):
+            yield maintainers, bug_ids[i:i + batch_size]
+
+
+def bugzilla_modify(bug_ids: list, maintainers: tuple, url: str, api_key: str or None, dry_run: bool) -> dict:
+    """
+    Assigns bugs to the given maintainers with a single Bugzilla REST request.
+
+    :param bug_ids: ids of bugs to modify
+    :type bug_ids: list
+    :param maintainers: maintainer emails, the first being the assignee
+    :type maintainers: tuple
+    :param url: base URL of the Bugzilla instance
+    :type url: str
+    :param api_key: Bugzilla API key to authenticate with
+    :type api_key: str or None
+    :param dry_run: only print the request rather than sending it
+    :type dry_run: bool
+    :returns: decoded JSON response (empty when dry_run is set)
+    :rtype: dict
+    """
+    assert isinstance(bug_ids, list) and len(bug_ids) > 0
+    assert isinstance(url, str)
+
+    body = {'ids': [int(i) for i in bug_ids], 'assigned_to': maintainers[0]}
+    if len(maintainers) > 1:
+        body['cc'] = {'add': list(maintainers[1:])}
+
+    endpoint = '%s/rest/bug/%s' % (url.rstrip('/'), bug_ids[0])
+    if dry_run:
+        print('PUT %s %s' % (endpoint, json.dumps(body)), file=sys.stderr)
+        return {}
+
+    request = urllib.request.Request(endpoint, data=json.dumps(body).encode(), method='PUT')
+    request.add_header('Content-Type', 'application/json')
+    request.add_header('Accept', 'application/json')
+    if api_key:
+        request.add_header('X-BUGZILLA-API-KEY', api_key)
+
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return json.loads(response.read().decode() or '{}')
+
+
+def apply_batches(batches, url: str, api_key: str or None, jobs: int, dry_run: bool) -> int:
+    """
+    Sends batched bug modifications to Bugzilla with at most `jobs` requests in flight.
+
+    :param batches: iterable of (maintainers, [bug_id, ...]) tuples
+    :type batches: iterable
+    :param url: base URL of the Bugzilla instance
+    :type url: str
+    :param api_key: Bugzilla API key to authenticate with
+    :type api_key: str or None
+    :param jobs: maximum number of concurrent requests
+    :type jobs: int
+    :param dry_run: only print the requests rather than sending them
+    :type dry_run: bool
+    :returns: number of failed requests
+    :rtype: int
+    """
+    assert isinstance(jobs, int) and jobs > 0
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [(bug_ids, executor.submit(bugzilla_modify, bug_ids, maintainers, url, api_key, dry_run))
+                   for maintainers, bug_ids in batches]
+        for bug_ids, future in futures:
+            try:
+                future.result()
+            except (OSError, ValueError) as err:
+                print('Error: failed to modify bugs %s: %s' % (', '.join(bug_ids), err), file=sys.stderr)
+                failed += 1
+
+    return failed
+
+
 def main():
     import argparse
 
     parser = argparse.ArgumentParser(description="Util for suggesting assignee/CC for bugs")
     parser.add_argument('-a', '--address', help="Only show bugs assigned or CC' to ADDRESS", required=False)
     parser.add_argument('-d', '--debug', help="Print debug output", action='store_true')
+    parser.add_argument('-i', '--input', help="Read CSV/NDJSON bug dump from FILE ('-' for STDIN) instead of bugz",
+                        type=argparse.FileType('r'), metavar='FILE')
+    parser.add_argument('-f', '--format', help="Output format (default: text)", choices=['text', 'ndjson'],
+                        default='text')
+    parser.add_argument('-b', '--batch', help="Group bugs with the same maintainers into bulk modify commands",
+                        action='store_true')
+    parser.add_argument('--batch-size', help="Maximum bugs per bulk modification (default: 100)", type=int,
+                        default=100, metavar='N')
+    parser.add_argument('--apply', help="Apply batched modifications through the Bugzilla REST API (implies --batch)",
+                        action='store_true')
+    parser.add_argument('-n', '--dry-run', help="Print REST requests for --apply rather than sending them",
+                        action='store_true')
+    parser.add_argument('-j', '--jobs', help="Maximum concurrent REST requests (default: 4)", type=int, default=4,
+                        metavar='N')
+    parser.add_argument('--url', help="Bugzilla base URL (default: %s)" % bugzilla_url, default=bugzilla_url)
+    parser.add_argument('--api-key', help="Bugzilla API key (default: $BUGZ_APIKEY)",
+                        default=os.environ.get('BUGZ_APIKEY'))
+    parser.add_argument('-w', '--workers', help="Maintainer lookup threads (default: 4)", type=int, default=4,
+                        metavar='N')
+    parser.add_argument('-o', '--order', help="Print bugs in the order they were read or as soon as they are "
+                        "resolved (default: input)", choices=['input', 'completion'], default='input')
     args = parser.parse_args()
 
-    bugz_output = get_bugz_output()
-    printable_bugs = []
-
-    for bug in bugz_output:
-        atom = find_atom(bug.summary)
-        if atom is not None:
-            maintainers = get_maintainers(atom)
-            if len(maintainers) == 0:
-                maintainers = tuple(['maintainer-needed@gentoo.org', ''])
-
-            # check if address (if supplied) is in maintainers
-            if args.address:
-                if args.address not in maintainers:
-                    if args.debug:
-                        print("Skipping atom %s as address not in maintainers" % atom)
-                    continue
-
-            printable_bugs.append(tuple([atom, bug, maintainers]))
-
-    unmatched = len(bugz_output) - len(printable_bugs)
-    if len(printable_bugs) > 0:
-        string = '%6s  %-30s  %-28s  %s'
-        print(string % ('Bug', 'Atom', 'Assignee', 'Maintainers'))
-        for atom, bug, maintainers in printable_bugs:
+    if args.apply:
+        args.batch = True
+    if args.batch_size < 1 or args.jobs < 1 or args.workers < 1:
+        parser.error('--batch-size, --jobs and --workers must be positive')
+    if args.apply and not args.dry_run and not args.api_key:
+        parser.error('--apply requires --api-key or $BUGZ_APIKEY')
+
+    if args.input:
+        bugs = read_bug_dump(args.input)
+    else:
+        bugs = iter_bugz_output()
+
+    total = 0
+    printed = 0
+    ambiguous = 0
+    assignments = []
+
+    for bug, atom, maintainers, candidates in suggest_bugs(bugs, args.workers, args.order == 'input'):
+        total += 1
+        if atom is None:
+            if len(candidates) > 1:
+                ambiguous += 1
+                if args.format == 'ndjson':
+                    print(json.dumps({'type': 'ambiguous', 'id': bug.id, 'summary': bug.summary,
+                                      'candidates': candidates}), flush=True)
+                elif args.debug:
+                    print("Ambiguous package for bug %s: %s" % (bug.id, ', '.join(candidates)), file=sys.stderr)
+            continue
+
+        # check if address (if supplied) is in maintainers
+        if args.address:
+            if args.address not in maintainers:
+                if args.debug:
+                    print("Skipping atom %s as address not in maintainers" % atom, file=sys.stderr)
+                continue
+
+        if args.batch:
+            assignments.append((bug.id, maintainers))
+
+        if args.format == 'ndjson':
+            print(json.dumps({'type': 'suggestion', 'id': bug.id, 'assignee': bug.assignee, 'summary': bug.summary,
+                              'atom': atom, 'maintainers': maintainers,
+                              'command': modify_command([bug.id], maintainers)}), flush=True)
+        else:
+            string = '%6s  %-30s  %-28s  %s'
+            if printed == 0:
+                print(string % ('Bug', 'Atom', 'Assignee', 'Maintainers'))
             print(string % (bug.id, atom, maintainers[0], ', '.join(maintainers[1:])))
             print('  %s' % bug.summary)
             print('  https://bugs.gentoo.org/%s' % bug.id)
-            if len(maintainers) > 1:
-                print('  bugz modify -a %s --add-cc %s %s' % (maintainers[0], ' --add-cc '.join(maintainers[1:]), bug.id))
-            else:
-                print('  bugz modify -a %s %s' % (maintainers[0], bug.id))
+            if not args.batch:
+                print('  %s' % modify_command([bug.id], maintainers))
+            print(flush=True)
+        printed += 1
+
+    unmatched = total - printed - ambiguous
+    failed = 0
+
+    if args.batch:
+        batches = list(group_assignments(assignments, args.batch_size))
+        if args.format == 'ndjson':
+            for maintainers, bug_ids in batches:
+                print(json.dumps({'type': 'batch', 'ids': bug_ids, 'maintainers': maintainers,
+                                  'command': modify_command(bug_ids, maintainers)}))
+        elif len(batches) > 0:
+            print('Batched commands (%d bugs in %d requests):' % (len(assignments), len(batches)))
+            for maintainers, bug_ids in batches:
+                print('  %s' % modify_command(bug_ids, maintainers))
             print()
-    else:
+
+        if args.apply:
+            failed = apply_batches(batches, args.url, args.api_key, args.jobs, args.dry_run)
+
+    if args.format == 'ndjson':
+        print(json.dumps({'type': 'summary', 'bugs': total, 'suggested': printed, 'ambiguous': ambiguous,
+                          'unmatched': unmatched}))
+        return 1 if failed else 0
+
+    if printed == 0:
         if args.address:
             print("No parseable bugs found for %r" % args.address)
         else:
@@ -168,6 +613,12 @@ def main():
         print("Note: %d bugs couldn't be parsed" % unmatched)
         print()
 
+    if ambiguous > 0:
+        print("Note: %d bugs matched packages in several categories" % ambiguous)
+        print()
+
+    return 1 if failed else 0
+
 
 if __name__ == '__main__':
-    main()
+    exit(main())
@@ -7,10 +7,16 @@ no longer required.
 """
 
 import argparse
+import collections
+import hashlib
+import json
 import os
 import re
+import subprocess
 import sys
 
+from concurrent.futures import ProcessPoolExecutor
+
 from portage.output import colorize as colorize
 
 
@@ -22,6 +28,35 @@ file_colour = 'teal'
 
 show_output = True
 debug = False
+eclass_dirs = []
+eclass_cache = {}
+eclass_digests = {}
+cache_version = 5
+cache_stats = collections.Counter()
+output_format = 'text'
+
+# exit statuses above 125 have special meaning to shells, so the missing count is capped below them
+max_exit_status = 125
+
+PackageResult = collections.namedtuple('PackageResult', ['path', 'required', 'optional', 'unused', 'unparsable',
+                                                         'eclasses'])
+ScriptInfo = collections.namedtuple('ScriptInfo', ['assignments', 'filesdir_lines', 'inherits'])
+EclassSummary = collections.namedtuple('EclassSummary', ['name', 'defaults', 'filesdir_lines', 'inherits'])
+non_category_dirs = frozenset(['eclass', 'licenses', 'metadata', 'profiles', 'scripts'])
+
+# FILESDIR expands to a marker so that references can't be confused with other text mentioning 'files'
+filesdir_marker = '\0files'
+comment_line = re.compile(r'^\s*#')
+trailing_comment = re.compile(r'\s+#[^"\'}]*$')
+assignment_line = re.compile(r'^\s*(?:(?:local|export|readonly|declare(?:\s+-\w+)*)\s+)?([A-Za-z_]\w*)(\+?=)(.*)$', re.S)
+default_assignment = re.compile(r'^\s*:\s+"?\$\{([A-Za-z_]\w*):?=((?:[^{}]|\$\{[^{}]*\})*)\}"?\s*$')
+inherit_line = re.compile(r'^\s*inherit\s+([^;#]*)')
+variable_ref = re.compile(r'\$(?:\{([A-Za-z_]\w*)\}|([A-Za-z_]\w*))')
+brace_list = re.compile(r'\{([^{}$]*,[^{}$]*)\}')
+filesdir_ref = re.compile('\0files(?:/[^\\s;|&()<>]*)?')
+ebuild_name = re.compile(r'^(.+?)-(\d[^-]*)(?:-(r\d+))?\.ebuild$')
+glob_chars = re.compile(r'[*?\[]')
+glob_token = re.compile(r'\*|\?|\[[^\]/]+\]|[^*?\[]+|\[')
 
 
 def main() -> int:
@@ -31,6 +66,19 @@ def main() -> int:
     parser.add_argument('-q', '--quiet', help='Print no output (overrides verbose)', action='store_false')
     parser.add_argument('-n', '--nocolour', help='Do not colourise output', action='store_true')
     parser.add_argument('-p', '--path', help='Path to ebuild directory', default=os.path.abspath(os.curdir))
+    parser.add_argument('-t', '--tree', help='Check every package in the repository at PATH', action='store_true')
+    parser.add_argument('-s', '--since', help='Check only packages in the repository at PATH changed since REV '
+                        '(or within a REV..REV range)', metavar='REV')
+    parser.add_argument('-j', '--jobs', help='Number of processes for --tree (default: CPU count)', type=int,
+                        default=os.cpu_count(), metavar='N')
+    parser.add_argument('-e', '--eclassdir', help='Eclass directory (default: eclass/ in the repository of PATH); '
+                        'may be given more than once', action='append', metavar='DIR')
+    parser.add_argument('-f', '--format', help='Output format (default: text)', choices=['text', 'json', 'ndjson'],
+                        default='text')
+    parser.add_argument('-c', '--cache', help='Reuse results for unchanged packages from FILE (default: '
+                        '$XDG_CACHE_HOME/check-files/cache.json)', nargs='?', metavar='FILE',
+                        const=os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                           'check-files', 'cache.json'))
     args = parser.parse_args()
 
     if args.nocolour:
@@ -39,116 +87,948 @@ def main() -> int:
 
     global show_output
     global debug
+    global eclass_dirs
+    global output_format
     show_output = args.quiet
     debug = args.debug
+    output_format = args.format
+
+    if args.eclassdir:
+        eclass_dirs = args.eclassdir
+    elif args.tree or args.since:
+        eclass_dirs = [os.path.join(args.path, 'eclass')]
+    else:
+        eclass_dirs = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(args.path))), 'eclass')]
 
     try:
-        return check_files(args.path)
+        if args.since:
+            missing_files = check_packages(changed_packages(args.path, args.since), 1, args.cache)
+        elif args.tree:
+            missing_files = check_tree(args.path, args.jobs, args.cache)
+        else:
+            missing_files = check_files(args.path, args.cache)
     except RuntimeError as err:
         print_err(str(err))
         return -1
 
+    return min(missing_files, max_exit_status)
+
 
-def check_files(directory: str) -> int:
+def check_files(directory: str, cache_path: str = None) -> int:
     """
     Checks files in $(pwd)/files for required files.
 
     :param directory: path to ebuild directory
-    :param debug: output match string for debugging
+    :param cache_path: path to result cache, or None to always scan
     :return: number of missing required files
     """
+    results = list(scan_packages([directory], 1, cache_path))
+
+    if len(results) == 0:
+        raise RuntimeError('Not a valid ebuild directory: %r' % directory)
+
+    if output_format != 'text':
+        report = JsonReport(output_format)
+        report.add(results[0])
+        return report.close()
+
+    return report_package(results[0], verbose=True)
+
+
+def check_tree(root: str, jobs: int, cache_path: str = None) -> int:
+    """
+    Checks every package directory in a repository, scanning packages concurrently.
+
+    :param root: path to repository root
+    :param jobs: number of worker processes
+    :param cache_path: path to result cache, or None to always scan
+    :return: number of missing required files across all packages
+    """
+    assert isinstance(root, str)
+    assert isinstance(jobs, int)
+
+    if jobs < 1:
+        raise RuntimeError('Invalid number of jobs: %d' % jobs)
+
+    directories = find_packages(root)
+    if len(directories) == 0:
+        raise RuntimeError('No packages found in repository: %r' % root)
+
+    return check_packages(directories, jobs, cache_path)
+
+
+def check_packages(directories: list, jobs: int, cache_path: str = None) -> int:
+    """
+    Checks the given package directories, reporting only packages with missing or unused files.
+
+    :param directories: paths to ebuild directories
+    :param jobs: number of worker processes
+    :param cache_path: path to result cache, or None to always scan
+    :return: number of missing required files across all packages
+    """
+    if output_format != 'text':
+        report = JsonReport(output_format)
+        for result in scan_packages(directories, jobs, cache_path):
+            report.add(result)
+        return report.close()
+
+    missing_files = 0
+
+    for result in scan_packages(directories, jobs, cache_path):
+        missing_files += report_package(result, verbose=False)
+
+    return missing_files
+
+
+def changed_packages(root: str, rev: str) -> list:
+    """
+    Asks git which package directories have ebuilds or FILESDIR entries changed since a revision.
+
+    :param root: path to repository root, which must be the top level of its git work tree
+    :param rev: revision to compare the working tree with, or a 'rev..rev' range
+    :return: sorted list of existing package directory paths
+    """
+    assert isinstance(root, str)
+    assert isinstance(rev, str)
+
+    try:
+        toplevel = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'], cwd=root).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        raise RuntimeError('Not a git repository: %r' % root)
+    if os.path.realpath(toplevel) != os.path.realpath(root):
+        raise RuntimeError('Not the root of a git repository: %r (root is %r)' % (root, toplevel))
+
+    try:
+        output = subprocess.check_output(['git', 'diff', '--name-only', '-z', rev, '--'], cwd=root)
+    except (OSError, subprocess.CalledProcessError) as err:
+        raise RuntimeError('Unable to list changes since %r: %s' % (rev, err))
+
+    directories = set()
+    for path in output.decode().split('\0'):
+        parts = path.split('/')
+        if len(parts) < 3 or parts[0] in non_category_dirs or parts[0].startswith('.'):
+            continue
+        if (len(parts) == 3 and parts[2].endswith('.ebuild')) or parts[2] == 'files':
+            directory = os.path.join(root, parts[0], parts[1])
+            if os.path.isdir(directory):
+                directories.add(directory)
+
+    print_dbg('Changed packages: %r' % sorted(directories))
+    return sorted(directories)
+
+
+def _init_worker(dirs: list, cache: dict, show_debug: bool) -> None:
+    """
+    Sets up the module state a worker process scans packages with, whichever way the process was started.
+
+    :param dirs: eclass directories
+    :param cache: preloaded eclass summaries
+    :param show_debug: whether to print debug output
+    :return: None
+    """
+    global eclass_dirs
+    global eclass_cache
+    global debug
+    eclass_dirs = dirs
+    eclass_cache = cache
+    debug = show_debug
+
+
+def scan_packages(directories: list, jobs: int, cache_path: str = None):
+    """
+    Scans package directories, in a process pool if more than one job is given, reusing cached results for
+    packages which haven't changed.
+
+    :param directories: paths to ebuild directories
+    :param jobs: number of worker processes
+    :param cache_path: path to result cache, or None to always scan
+    :return: generator of PackageResult in the order of directories, skipping directories without ebuilds
+    """
+    executor = None
+    if jobs > 1:
+        # parse eclasses once up front so workers share the summaries
+        preload_eclasses()
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                       initargs=(eclass_dirs, eclass_cache, debug))
+
+    try:
+        # results are yielded as they arrive so reports can stream while the rest of the tree is scanned
+        if cache_path is None:
+            if executor is None:
+                results = map(scan_package, directories)
+            else:
+                results = executor.map(scan_package, directories, chunksize=32)
+            for result in results:
+                if result is not None:
+                    yield result
+            return
+
+        cache = load_cache(cache_path)
+        entries = [cache.get(os.path.abspath(d)) for d in directories]
+
+        if executor is None:
+            scanned = map(scan_cached, directories, entries)
+        else:
+            scanned = executor.map(scan_cached, directories, entries, chunksize=32)
+
+        hits = 0
+        misses = 0
+        for directory, (result, entry, hit) in zip(directories, scanned):
+            if entry is None:
+                cache.pop(os.path.abspath(directory), None)
+            else:
+                cache[os.path.abspath(directory)] = entry
+            if hit:
+                hits += 1
+            else:
+                misses += 1
+            if result is not None:
+                yield result
+
+        save_cache(cache_path, cache)
+        cache_stats['hits'] += hits
+        cache_stats['misses'] += misses
+        print('Cache: %d hits, %d misses' % (hits, misses), file=sys.stderr)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def find_packages(root: str) -> list:
+    """
+    Lists package directories within a repository.
+
+    :param root: path to repository root
+    :return: sorted list of package directory paths
+    """
+    assert isinstance(root, str)
+
+    directories = []
+    for category in os.scandir(root):
+        if not category.is_dir() or category.name.startswith('.') or category.name in non_category_dirs:
+            continue
+        for package in os.scandir(category.path):
+            if package.is_dir() and not package.name.startswith('.'):
+                directories.append(package.path)
+
+    directories.sort()
+    return directories
+
+
+def scan_package(directory: str) -> PackageResult or None:
+    """
+    Collects the files required by ebuilds in a directory and those no longer required.
+
+    :param directory: path to ebuild directory
+    :return: PackageResult of {PF: [(file, exists), ...]}, files used through eclasses, unused files and unparsable
+             lines; None without ebuilds
+    """
     assert isinstance(directory, str)
     assert isinstance(debug, bool)
 
     ebuilds = [f for f in os.listdir(directory) if f.endswith('.ebuild')]
 
     if len(ebuilds) == 0:
-        raise RuntimeError('Not a valid ebuild directory: %r' % directory)
+        return None
 
-    files = {}
-    missing_files = 0
+    category = os.path.basename(os.path.dirname(os.path.abspath(directory)))
+    required = {}
+    optional = []
+    unparsable = []
+    eclass_names = set()
 
     for ebuild in ebuilds:
-        P = ebuild[:-7]
-        P = re.sub('-r\d+', '', P)
-        PN = re.sub('-\d.*', '', P)
-        PV = re.search('-\d.*', P).group(0)[1:]
-
-        for line in open(os.path.join(directory, ebuild), 'r').readlines():
-            if 'FILESDIR' in line:
-                org_line = line.strip()
-
-                # Ignore comment lines
-                if re.match('\s*#', line):
-                    continue
-
-                line = line.replace('${FILESDIR}', 'files')
-                line = line.replace('${P}', P)
-                line = line.replace('${PN}', PN)
-                line = line.replace('${PV}', PV)
-                line = line.replace('"', '')
-                line = line.replace('.patch)', '.patch')
-
-                print_dbg('%r -> %r' % (org_line, line.strip()))
-
-                try:
-                    required_file = re.search('files\S+', line).group(0)
-                except AttributeError:
-                    print_err('Unable to get path from string: %r' % line.strip())
-                    continue
-
-                try:
-                    files[P]
-                except KeyError:
-                    files[P] = []
-                files[P].append(required_file)
-
-    file_list = list(files.keys())
+        variables = ebuild_variables(ebuild, category)
+        if variables is None:
+            unparsable.append('Invalid ebuild name: %s' % ebuild)
+            continue
+
+        with open(os.path.join(directory, ebuild), 'r') as handle:
+            info = parse_script(handle.read())
+
+        refs, bad_lines = script_references(info, variables)
+        unparsable.extend(bad_lines)
+
+        required[variables['PF']] = refs
+
+        # files referenced by eclasses are used if present, but eclasses generally don't require them
+        for eclass in inherited_eclasses(info.inherits):
+            eclass_names.add(eclass.name)
+            if len(eclass.filesdir_lines) == 0:
+                continue
+            expand_assignments(eclass.defaults, variables)
+            eclass_refs, bad_lines = find_references(eclass.filesdir_lines, variables)
+            for line in bad_lines:
+                line = '%s.eclass: %s' % (eclass.name, line)
+                if line not in unparsable:
+                    unparsable.append(line)
+            for f in eclass_refs:
+                if f not in optional:
+                    optional.append(f)
+
+    files_dir = list_files(directory)
+    directories = set()
+    for path in files_dir:
+        parent = os.path.dirname(path)
+        while parent and parent not in directories:
+            directories.add(parent)
+            parent = os.path.dirname(parent)
+
+    matcher = FileMatcher([f for l in required.values() for f in l], optional, directories)
+    print_dbg(repr(sorted(matcher.exact)), repr(sorted(matcher.globs)))
+
+    not_required = []
+    for path in files_dir:
+        if not matcher.match(path):
+            print_dbg('PATH NOT REQUIRED: %r' % path)
+            not_required.append(path)
+
+    for pkg, refs in required.items():
+        required[pkg] = [(f, matcher.found(f)) for f in refs]
+
+    return PackageResult(directory, required, optional, not_required, unparsable, sorted(eclass_names))
+
+
+def scan_cached(directory: str, entry: dict or None) -> tuple:
+    """
+    Returns the cached result for a package if its ebuilds, FILESDIR listing and inherited eclasses are unchanged,
+    otherwise scans it.
+
+    Ebuild mtimes and sizes are compared first so unchanged packages are answered without reading their ebuilds;
+    when those differ (e.g. after a fresh checkout) the ebuild contents are hashed and compared instead.
+
+    :param directory: path to ebuild directory
+    :param entry: cache entry from a previous run, or None
+    :return: tuple of (PackageResult or None, new cache entry or None, whether the cache was hit)
+    """
+    ebuilds = sorted([e for e in os.scandir(directory) if e.name.endswith('.ebuild')], key=lambda e: e.name)
+    if len(ebuilds) == 0:
+        return None, None, False
+
+    files_dir = list_files(directory)
+
+    def signature(eclasses):
+        return [[[e.name, e.stat().st_mtime_ns, e.stat().st_size] for e in ebuilds], files_dir,
+                [[name, _eclass_digest(name)] for name in eclasses], eclass_dirs]
+
+    def digest(eclasses):
+        hashed = hashlib.sha1(json.dumps([cache_version, files_dir, eclasses, eclass_dirs]).encode())
+        for ebuild in ebuilds:
+            hashed.update(ebuild.name.encode())
+            with open(ebuild.path, 'rb') as handle:
+                hashed.update(handle.read())
+        for name in eclasses:
+            hashed.update(_eclass_digest(name).encode())
+        return hashed.hexdigest()
+
+    if entry is not None and entry.get('version') == cache_version:
+        eclasses = entry['result']['eclasses']
+        if entry['stat'] == signature(eclasses) or entry['digest'] == digest(eclasses):
+            result = entry['result']
+            required = {pkg: [tuple(r) for r in refs] for pkg, refs in result['required'].items()}
+            entry['stat'] = signature(eclasses)
+            return PackageResult(**dict(result, path=directory, required=required)), entry, True
+
+    result = scan_package(directory)
+    entry = {'version': cache_version, 'stat': signature(result.eclasses), 'digest': digest(result.eclasses),
+             'result': result._asdict()}
+    return result, entry, False
+
+
+def _eclass_digest(name: str) -> str:
+    """
+    Hashes an eclass, once per process.
+
+    :param name: eclass name
+    :return: hex digest of the eclass contents, or an empty string if it can't be found
+    """
+    try:
+        return eclass_digests[name]
+    except KeyError:
+        pass
+
+    eclass_digests[name] = ''
+    for eclass_dir in eclass_dirs:
+        path = os.path.join(eclass_dir, name + '.eclass')
+        if os.path.isfile(path):
+            with open(path, 'rb') as handle:
+                eclass_digests[name] = hashlib.sha1(handle.read()).hexdigest()
+            break
+
+    return eclass_digests[name]
+
+
+def load_cache(path: str) -> dict:
+    """
+    Loads the result cache, starting afresh if it's missing or unreadable.
+
+    :param path: path to cache file
+    :return: dictionary of {package path: entry}
+    """
+    try:
+        with open(path, 'r') as handle:
+            cache = json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(cache, dict):
+        return {}
+    return cache
+
+
+def save_cache(path: str, cache: dict) -> None:
+    """
+    Writes the result cache atomically.
+
+    :param path: path to cache file
+    :param cache: dictionary of {package path: entry}
+    :return: None
+    """
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.tmp', 'w') as handle:
+            json.dump(cache, handle)
+        os.replace(path + '.tmp', path)
+    except OSError as err:
+        print_err('Unable to write cache %r: %s' % (path, err))
+    return
+
+
+def list_files(directory: str) -> list:
+    """
+    Lists every file within the FILESDIR of a package, including those in subdirectories.
+
+    :param directory: path to ebuild directory
+    :return: sorted list of paths relative to the ebuild directory, e.g. 'files/foo.patch'
+    """
+    paths = []
+    pending = ['files']
+
+    while pending:
+        relative = pending.pop()
+        try:
+            entries = list(os.scandir(os.path.join(directory, relative)))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                pending.append(relative + '/' + entry.name)
+            else:
+                paths.append(relative + '/' + entry.name)
+
+    paths.sort()
+    return paths
+
+
+class FileMatcher(object):
+    """
+    Matches FILESDIR paths against required references: plain references are kept in a set, references to existing
+    subdirectories of FILESDIR match everything below them and globbed references are compiled to patterns.
+    """
+
+    def __init__(self, refs: list, optional: list = (), directories: set = frozenset()):
+        """
+        :param refs: references required by ebuilds
+        :param optional: references made by eclasses, which never match whole directories
+        :param directories: directories within FILESDIR, e.g. 'files' and 'files/1.2'
+        """
+        self.exact = set()
+        self.globs = {}
+        self.prefixes = set()
+        self.matched = set()
+        self.directories = directories
+
+        for ref in list(refs) + list(optional):
+            if glob_chars.search(ref):
+                self.globs[ref] = re.compile(_glob_pattern(ref))
+            else:
+                self.exact.add(ref)
+
+        # a bare ${FILESDIR} doesn't make every file used
+        for ref in refs:
+            if ref in directories and ref != 'files':
+                self.prefixes.add(ref + '/')
+
+        self.prefixes = tuple(self.prefixes)
+
+    def match(self, path: str) -> bool:
+        """
+        Checks whether a path in FILESDIR is used by any reference, noting which references matched.
+
+        :param path: path relative to the ebuild directory
+        :return: True if the path is referenced, otherwise False
+        """
+        used = False
+
+        if path in self.exact:
+            self.matched.add(path)
+            used = True
+        elif self.prefixes and path.startswith(self.prefixes):
+            for prefix in self.prefixes:
+                if path.startswith(prefix):
+                    self.matched.add(prefix[:-1])
+            used = True
+
+        for ref, pattern in self.globs.items():
+            if pattern.match(path):
+                self.matched.add(ref)
+                used = True
+
+        return used
+
+    def found(self, ref: str) -> bool:
+        """
+        Checks whether a reference matched any path passed to match(), or names a directory within FILESDIR.
+
+        :param ref: required reference
+        :return: True if the reference was found, otherwise False
+        """
+        return ref in self.matched or ref in self.directories
+
+
+def _glob_pattern(glob: str) -> str:
+    """
+    Translates a shell glob into a regular expression; unlike fnmatch, wildcards don't match '/'.
+
+    :param glob: shell glob
+    :return: regular expression string
+    """
+    pattern = ''
+    for part in glob_token.findall(glob):
+        if part == '*':
+            pattern += '[^/]*'
+        elif part == '?':
+            pattern += '[^/]'
+        elif part.startswith('[') and len(part) > 1:
+            pattern += '[^' + part[2:] if part[1] in '!^' else part
+        else:
+            pattern += re.escape(part)
+    return pattern + '$'
+
+
+def load_eclass(name: str) -> EclassSummary or None:
+    """
+    Returns the summary of an eclass, parsing it on first use.
+
+    :param name: eclass name
+    :return: EclassSummary, or None if the eclass can't be found in the eclass directories
+    """
+    try:
+        return eclass_cache[name]
+    except KeyError:
+        pass
+
+    summary = None
+    for eclass_dir in eclass_dirs:
+        path = os.path.join(eclass_dir, name + '.eclass')
+        if os.path.isfile(path):
+            with open(path, 'r') as handle:
+                info = parse_script(handle.read())
+
+            summary = EclassSummary(name, [a for a in info.assignments if a[1] == ':='],
+                                    [line for index, line in info.filesdir_lines],
+                                    info.inherits)
+            break
+
+    if summary is None:
+        print_dbg('Eclass not found: %r' % name)
+
+    eclass_cache[name] = summary
+    return summary
+
+
+def preload_eclasses() -> None:
+    """
+    Parses every eclass in the eclass directories into the eclass cache.
+
+    :return: None
+    """
+    for eclass_dir in eclass_dirs:
+        if not os.path.isdir(eclass_dir):
+            continue
+        for entry in os.scandir(eclass_dir):
+            if entry.name.endswith('.eclass'):
+                load_eclass(entry.name[:-7])
+
+
+def inherited_eclasses(inherits: list) -> list:
+    """
+    Resolves the eclasses inherited directly and indirectly.
+
+    :param inherits: names of directly inherited eclasses
+    :return: list of EclassSummary, each eclass listed once
+    """
+    eclasses = []
+    seen = set()
+    pending = list(reversed(inherits))
+
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+
+        eclass = load_eclass(name)
+        if eclass is not None:
+            eclasses.append(eclass)
+            pending.extend(reversed(eclass.inherits))
+
+    return eclasses
+
+
+def ebuild_variables(ebuild: str, category: str) -> dict or None:
+    """
+    Builds the package manager defined variables for an ebuild from its file name.
+
+    :param ebuild: ebuild file name
+    :param category: package category
+    :return: dictionary of {variable: value}, or None if the name is not a valid ebuild name
+    """
+    match = ebuild_name.match(ebuild)
+    if match is None:
+        return None
+
+    PN, PV, PR = match.groups()
+    PVR = PV if PR is None else '%s-%s' % (PV, PR)
+
+    return {
+        'CATEGORY': category,
+        'FILESDIR': filesdir_marker,
+        'P': '%s-%s' % (PN, PV),
+        'PF': '%s-%s' % (PN, PVR),
+        'PN': PN,
+        'PR': 'r0' if PR is None else PR,
+        'PV': PV,
+        'PVR': PVR,
+    }
+
+
+def parse_script(text: str) -> ScriptInfo:
+    """
+    Reads an ebuild or eclass in a single pass, collecting variable assignments, inherited eclasses and the logical
+    (continuation and array joined) lines which reference FILESDIR, each with the number of assignments made up to
+    and including that line.
+
+    :param text: ebuild or eclass contents
+    :return: ScriptInfo of [(name, operator, value), ...], [(index, line), ...] and [eclass, ...]
+    """
+    assignments = []
+    filesdir_lines = []
+    inherits = []
+    logical = ''
+
+    for line in text.splitlines():
+        if comment_line.match(line):
+            continue
+
+        logical += trailing_comment.sub('', line)
+        if logical.endswith('\\'):
+            logical = logical[:-1]
+            continue
+
+        match = assignment_line.match(logical)
+        if match and match.group(3).startswith('(') and logical.count('(') > logical.count(')'):
+            # array assignment continues on the next line
+            logical += ' '
+            continue
+
+        if match:
+            name, operator, value = match.groups()
+            if not value.startswith('('):
+                assignments.append((name, operator, _unquote(value)))
+        else:
+            match = default_assignment.match(logical)
+            if match:
+                assignments.append((match.group(1), ':=', _unquote(match.group(2))))
+
+        match = inherit_line.match(logical)
+        if match:
+            inherits.extend(match.group(1).split())
+
+        if 'FILESDIR' in logical:
+            filesdir_lines.append((len(assignments), logical.strip()))
+
+        logical = ''
+
+    return ScriptInfo(assignments, filesdir_lines, inherits)
+
+
+def expand_assignments(assignments: list, variables: dict) -> dict:
+    """
+    Applies variable assignments in order, expanding references to previously assigned variables.
+
+    :param assignments: list of (name, operator, value) from parse_script
+    :param variables: dictionary of {variable: value} to update
+    :return: the updated variables
+    """
+    for name, operator, value in assignments:
+        value = expand(value, variables)
+        if operator == '+=':
+            variables[name] = variables.get(name, '') + value
+        elif operator == ':=':
+            variables.setdefault(name, value)
+        else:
+            variables[name] = value
+
+    return variables
+
+
+def expand(text: str, variables: dict) -> str:
+    """
+    Expands $VAR and ${VAR} references to known variables, leaving unknown references untouched.
+
+    :param text: text to expand
+    :param variables: dictionary of {variable: value}
+    :return: expanded text
+    """
+    if '$' not in text:
+        return text
+    return variable_ref.sub(lambda m: variables.get(m.group(1) or m.group(2), m.group(0)), text)
+
+
+def script_references(info: ScriptInfo, variables: dict) -> tuple:
+    """
+    Extracts the files a script refers to, expanding each FILESDIR line with the variables as assigned at that line,
+    so that e.g. a local reused by several functions resolves to its value in each. Variables not yet assigned at a
+    line take their final value, as for globals assigned below the functions using them.
+
+    :param info: ScriptInfo from parse_script
+    :param variables: dictionary of {variable: value}, updated with every assignment of the script
+    :return: tuple of ([path, ...], [unparsable line, ...]), as find_references
+    """
+    refs = []
+    unparsable = []
+    applied = 0
+    final = expand_assignments(info.assignments, dict(variables))
+
+    for index, line in info.filesdir_lines:
+        expand_assignments(info.assignments[applied:index], variables)
+        applied = index
+        line_refs, bad_lines = find_references([line], collections.ChainMap(variables, final))
+        refs.extend(f for f in line_refs if f not in refs)
+        unparsable.extend(l for l in bad_lines if l not in unparsable)
+
+    expand_assignments(info.assignments[applied:], variables)
+    return refs, unparsable
+
+
+def find_references(lines: list, variables: dict) -> tuple:
+    """
+    Expands lines referencing FILESDIR and extracts every file path they refer to.
+
+    :param lines: logical lines referencing FILESDIR
+    :param variables: dictionary of {variable: value}, FILESDIR included
+    :return: tuple of ([path, ...], [unparsable line, ...]), paths being relative to the package directory
+    """
+    refs = []
+    unparsable = []
+
+    for line in lines:
+        expanded = expand(line, variables).replace('"', '').replace("'", '')
+        found = filesdir_ref.findall(expanded)
+        print_dbg('%r -> %r' % (line, [f[1:] for f in found]))
+
+        if len(found) == 0:
+            unparsable.append(line)
+            continue
+
+        for ref in found:
+            for path in _expand_braces(ref[1:].rstrip('/')):
+                if '$' in path:
+                    # references something we couldn't expand
+                    if line not in unparsable:
+                        unparsable.append(line)
+                elif path not in refs:
+                    refs.append(path)
+
+    return refs, unparsable
+
+
+def _unquote(value: str) -> str:
+    """
+    Strips quoting from an assigned shell value.
+
+    :param value: raw assigned value
+    :return: unquoted value
+    """
+    value = value.strip()
+    if value[:1] in ('"', "'"):
+        # anything after the closing quote, e.g. '; true', isn't part of the value
+        end = value.find(value[0], 1)
+        return value[1:end] if end > 0 else value[1:]
+    return re.split(r'[\s;&|]', value, 1)[0]
+
+
+def _expand_braces(path: str) -> list:
+    """
+    Expands simple (non-nested) shell brace lists, e.g. foo-{a,b}.patch.
+
+    :param path: path to expand
+    :return: list of expanded paths
+    """
+    match = brace_list.search(path)
+    if match is None:
+        return [path]
+
+    paths = []
+    for option in match.group(1).split(','):
+        paths.extend(_expand_braces(path[:match.start()] + option + path[match.end():]))
+    return paths
+
+
+def report_package(result: PackageResult, verbose: bool) -> int:
+    """
+    Prints the outcome of scanning a package.
+
+    :param result: scanned package
+    :param verbose: list found files per ebuild rather than only problems
+    :return: number of missing required files
+    """
+    assert isinstance(result, PackageResult)
+
+    missing_files = 0
+    file_list = list(result.required.keys())
     file_list.sort()
 
-    files_dir_path = os.path.join(directory, 'files')
+    for line in result.unparsable:
+        print_err('Unable to get path from string: %r' % line)
+
+    if not verbose:
+        missing = [f for l in result.required.values() for f, exists in l if not exists]
+        if len(missing) == 0 and len(result.unused) == 0:
+            return 0
+
+        missing = sorted(set(missing))
+        print_out(_p_pkg(_package_name(result.path)))
+        for f in missing:
+            print_out(' ', _p_warn('missing:'), _p_file(os.path.relpath(f, 'files')))
+        for f in sorted(result.unused):
+            print_out(' ', _p_warn(' unused:'), _p_file(os.path.relpath(f, 'files')))
+
+        return len(missing)
+
+    files_dir_path = os.path.join(result.path, 'files')
 
     if len(file_list) > 0:
         if not os.path.isdir(files_dir_path):
-            print_err('FILESDIR does not exist - %d files missing!' % len(file_list))
-
             # All patch files are missing
-            for l in files.values():
-                for v in l:
-                    missing_files += len(v)
+            for l in result.required.values():
+                missing_files += len(l)
+
+            print_err('FILESDIR does not exist - %d files missing!' % missing_files)
 
         else:
             for pkg in file_list:
                 print_out(_p_pkg(pkg))
 
-                for f in files[pkg]:
-                    if not os.path.isfile(os.path.join(directory, f)):
-                        print_dbg('PATH NOT FOUND: %r' % os.path.join(directory, 'files', f))
-                        print_out(' ', _p_warn('missing:'), _p_file(os.path.basename(f)))
+                for f, exists in result.required[pkg]:
+                    if not exists:
+                        print_dbg('PATH NOT FOUND: %r' % os.path.join(result.path, f))
+                        print_out(' ', _p_warn('missing:'), _p_file(os.path.relpath(f, 'files')))
                         missing_files += 1
                     else:
-                        print_out(' ', _p_good('  found:'), _p_file(os.path.basename(f)))
+                        print_out(' ', _p_good('  found:'), _p_file(os.path.relpath(f, 'files')))
 
-    required_files = [v for l in files.values() for v in l]
-    print_dbg(required_files)
+    eclass_files = [f for f in result.optional if os.path.exists(os.path.join(result.path, f))]
+    if len(eclass_files) > 0:
+        print_out('')
+        print_out('The following files are used by eclasses:')
+        [print_out('   ', _p_file(os.path.relpath(f, 'files'))) for f in eclass_files]
 
-    if os.path.isdir(files_dir_path):
-        not_required = []
-        files_dir = [f for f in os.listdir(files_dir_path)]
-        for f in files_dir:
-            path = os.path.join('files', f)
-            if path not in required_files:
-                print_dbg('PATH NOT REQUIRED: %r' % path)
-                not_required.append(path)
-
-        if len(not_required) > 0:
-            print_out('')
-            print_out('The following files are no longer required:')
-            [print_out('   ', _p_file(os.path.basename(f))) for f in not_required]
+    if len(result.unused) > 0:
+        print_out('')
+        print_out('The following files are no longer required:')
+        [print_out('   ', _p_file(os.path.relpath(f, 'files'))) for f in result.unused]
 
     return missing_files
 
 
+class JsonReport(object):
+    """
+    Streams package results as a JSON document or as NDJSON records, followed by a summary.
+    """
+
+    def __init__(self, fmt: str, stream=None, buffer_size: int = 65536):
+        assert fmt in ('json', 'ndjson')
+
+        self.format = fmt
+        self.stream = sys.stdout if stream is None else stream
+        self.buffer = []
+        self.buffered = 0
+        self.buffer_size = buffer_size
+        self.summary = collections.Counter(packages=0, missing=0, unused=0, unparsable=0)
+
+        if self.format == 'json':
+            self._write('{"packages": [')
+
+    def add(self, result: PackageResult) -> int:
+        """
+        Writes the record for a scanned package.
+
+        :param result: scanned package
+        :return: number of missing required files
+        """
+        found = set(f for l in result.required.values() for f, exists in l if exists)
+        missing = set(f for l in result.required.values() for f, exists in l if not exists)
+        eclass = [f for f in result.optional if os.path.exists(os.path.join(result.path, f))]
+
+        record = json.dumps({'type': 'package', 'package': _package_name(result.path), 'found': sorted(found),
+                             'missing': sorted(missing), 'unused': sorted(result.unused),
+                             'unparsable': result.unparsable, 'eclass': eclass})
+
+        if self.format == 'json':
+            self._write(record if self.summary['packages'] == 0 else ', ' + record)
+        else:
+            self._write(record + '\n')
+
+        self.summary['packages'] += 1
+        self.summary['missing'] += len(missing)
+        self.summary['unused'] += len(result.unused)
+        self.summary['unparsable'] += len(result.unparsable)
+
+        return len(missing)
+
+    def close(self) -> int:
+        """
+        Writes the summary and flushes remaining output.
+
+        :return: total number of missing required files
+        """
+        summary = dict(type='summary', cache_hits=cache_stats['hits'], cache_misses=cache_stats['misses'],
+                       **self.summary)
+
+        if self.format == 'json':
+            self._write('], "summary": %s}\n' % json.dumps(summary))
+        else:
+            self._write(json.dumps(summary) + '\n')
+
+        self._flush()
+        return self.summary['missing']
+
+    def _write(self, text: str) -> None:
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        self.stream.write(''.join(self.buffer))
+        self.stream.flush()
+        self.buffer = []
+        self.buffered = 0
+
+
+def _package_name(path: str) -> str:
+    """
+    Returns the category/package name of a package directory.
+
+    :param path: path to ebuild directory
+    :return: category/package
+    """
+    path = os.path.abspath(path)
+    return os.path.relpath(path, os.path.dirname(os.path.dirname(path)))
+
+
 def print_out(*message: list) -> None:
     """
     Wrapper for conditionally printing messages.
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Loopback stand-in for the Bugzilla REST API, recording the bug modifications check-bugs.py sends so that --apply and
+batching can be checked without touching a real Bugzilla, e.g.:
+
+    ./fake-bugzilla.py -o requests.ndjson &
+    ./check-bugs.py -i bugs.csv -b --apply --url http://127.0.0.1:8765
+"""
+
+import http.server
+import json
+import re
+import sys
+import threading
+
+bug_path = re.compile(r'^/rest/bug/(\d+)$')
+record_lock = threading.Lock()
+
+
+class BugzillaHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers PUT /rest/bug/<id> the way Bugzilla does, appending each request to the server's record file.
+    """
+
+    def do_PUT(self):
+        match = bug_path.match(self.path)
+        if match is None:
+            self.reply(404, {'error': True, 'message': 'Unknown resource: %s' % self.path})
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+        except ValueError as err:
+            self.reply(400, {'error': True, 'message': 'Invalid JSON: %s' % err})
+            return
+
+        api_key = self.headers.get('X-BUGZILLA-API-KEY')
+        record = {'path': self.path, 'api_key': api_key, 'body': body}
+        with record_lock:
+            self.server.record.write(json.dumps(record) + '\n')
+            self.server.record.flush()
+
+        ids = [int(i) for i in body.get('ids', [match.group(1)])]
+        if self.server.api_key is not None and api_key != self.server.api_key:
+            self.reply(401, {'error': True, 'message': 'Invalid API key'})
+        elif self.server.failing & set(ids):
+            self.reply(500, {'error': True, 'message': 'Failing bugs: %s' % sorted(self.server.failing & set(ids))})
+        else:
+            self.reply(200, {'bugs': [{'id': i, 'changes': {}} for i in ids]})
+
+    def reply(self, status: int, data: dict) -> None:
+        """
+        Sends a JSON response.
+
+        :param status: HTTP status code
+        :type status: int
+        :param data: response body
+        :type data: dict
+        :returns: None
+        """
+        out = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Loopback stand-in for the Bugzilla REST API")
+    parser.add_argument('-p', '--port', help="Port to listen on, 0 for any (default: 8765)", type=int, default=8765)
+    parser.add_argument('-o', '--output', help="Append received requests to FILE as NDJSON (default: STDOUT)",
+                        type=argparse.FileType('a'), default=sys.stdout, metavar='FILE')
+    parser.add_argument('-k', '--api-key', help="Reject requests without this API key")
+    parser.add_argument('-f', '--fail', help="Answer requests modifying bug ID with an error", type=int,
+                        action='append', default=[], metavar='ID')
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', args.port), BugzillaHandler)
+    server.record = args.output
+    server.api_key = args.api_key
+    server.failing = set(args.fail)
+    print('Listening on http://127.0.0.1:%d' % server.server_address[1], file=sys.stderr, flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
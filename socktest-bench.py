@@ -0,0 +1,199 @@
+#! /usr/bin/env python3
+
+# Benchmarks socktest.py against loopback fixtures: ports that accept, ports that refuse and ports that
+# drop SYNs because their accept queue is full. Nothing leaves the machine.
+
+import os
+import sys
+import time
+import json
+import socket
+import hashlib
+import argparse
+import resource
+import selectors
+import subprocess
+import collections
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def raiseFileLimit():
+    # Thousands of fixture ports and connections in progress need more descriptors than the usual 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+def runFixtures(base, nopen, nrefused, nblackhole):
+    # Binds consecutive ports from `base`: `nopen` listening ones that accept and close every connection,
+    # `nrefused` bound but not listening so connects are reset, and `nblackhole` listening with a backlog
+    # already full of connections that are never accepted, so further SYNs are dropped. Prints the port
+    # ranges as JSON once ready and serves until stdin is closed
+    sel = selectors.DefaultSelector()
+    keep = []
+    port = base
+    ranges = {}
+    for kind, n in (('open', nopen), ('refused', nrefused), ('blackhole', nblackhole)):
+        ranges[kind] = (port, port + n - 1) if n else None
+        for p in range(port, port + n):
+            s = socket.socket()
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(('127.0.0.1', p))
+            keep.append(s)
+            if kind == 'open':
+                s.listen(4096)
+                s.setblocking(False)
+                sel.register(s, selectors.EVENT_READ)
+            elif kind == 'blackhole':
+                s.listen(0)
+                for i in range(3):
+                    c = socket.socket()
+                    c.setblocking(False)
+                    c.connect_ex(('127.0.0.1', p))
+                    keep.append(c)
+        port += n
+    time.sleep(0.2)   # let the blackhole backlogs fill
+    sel.register(sys.stdin, selectors.EVENT_READ)
+    print(json.dumps(ranges), flush=True)
+    while True:
+        for key, events in sel.select():
+            if key.fileobj is sys.stdin:
+                if not sys.stdin.readline(): return
+                continue
+            try:
+                while True: key.fileobj.accept()[0].close()
+            except (BlockingIOError, InterruptedError):
+                pass
+
+def portSpec(ranges, names):
+    # Builds a socktest.py port specification from fixture kinds joined by '+', e.g. 'open+refused', and
+    # returns it with the ports it covers
+    kinds = ranges if names == 'all' else names.split('+')
+    parts = []
+    ports = set()
+    for kind in kinds:
+        if kind not in ranges:
+            print('Unknown fixture kind:', kind); exit(2)
+        if ranges[kind]:
+            parts.append('{}-{}'.format(*ranges[kind]))
+            ports.update(range(ranges[kind][0], ranges[kind][1] + 1))
+    return ','.join(parts), ports
+
+def expected(ranges, port):
+    for kind, r in ranges.items():
+        if r and r[0] <= port <= r[1]: return {'open': 'open', 'refused': 'refused', 'blackhole': 'timeout'}[kind]
+
+def scannerVersion(path):
+    # Git revision of the scanner when it is unmodified, plus a hash of its content
+    with open(path, 'rb') as f: digest = hashlib.sha1(f.read()).hexdigest()[:12]
+    try:
+        out = subprocess.run(['git', 'log', '-1', '--format=%h', '--', os.path.basename(path)],
+                             cwd=os.path.dirname(os.path.abspath(path)), capture_output=True, text=True)
+        dirty = subprocess.run(['git', 'diff', '--quiet', '--', os.path.basename(path)],
+                               cwd=os.path.dirname(os.path.abspath(path))).returncode
+        rev = out.stdout.strip()
+    except OSError:
+        rev, dirty = '', 1
+    return (rev + ('+' if dirty else '') + ':' if rev else '') + digest
+
+def runScan(scanner, spec, concurrency, timeout, extra):
+    # Runs one scan, returning wall time, peak memory of the scanner in KiB and the states per port
+    cmd = [sys.executable, scanner, '127.0.0.1', '-p', spec, '-c', str(concurrency), '--host-limit',
+           str(concurrency), '-t', str(timeout), '--format', 'ndjson'] + extra
+    start = time.perf_counter()
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    states = {}
+    for line in p.stdout:
+        try: record = json.loads(line)
+        except ValueError: continue
+        states[record['port']] = record['state']
+    pid, status, usage = os.wait4(p.pid, 0)
+    wall = time.perf_counter() - start
+    p.returncode = os.waitstatus_to_exitcode(status)
+    return wall, usage.ru_maxrss, states, p.returncode
+
+def previousRuns(path):
+    runs = {}
+    if not os.path.exists(path): return runs
+    with open(path) as f:
+        for line in f:
+            try: run = json.loads(line)
+            except ValueError: continue
+            runs[(run['spec'], run['ports'], run['concurrency'], tuple(run['extra']))] = run
+    return runs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks socktest.py against loopback fixtures',
+                     epilog='Fixture kinds are open, refused and blackhole; join them with "+" or use "all"')
+    parser.add_argument('-s', '--spec', help='fixture kinds to scan, may be repeated (def: open+refused)',
+                        action='append')
+    parser.add_argument('-c', '--concurrency', help='concurrency to scan with, may be repeated (def: 100)',
+                        action='append', type=int)
+    parser.add_argument('-n', '--repeat', help='runs per scenario, the fastest is recorded (def: 3)', default=3,
+                        type=int)
+    parser.add_argument('-t', '--timeout', help='scanner connect timeout in seconds (def: 1)', default=1.0,
+                        type=float)
+    parser.add_argument('--open', help='listening ports (def: 2000)', default=2000, type=int)
+    parser.add_argument('--refused', help='refusing ports (def: 2000)', default=2000, type=int)
+    parser.add_argument('--blackhole', help='ports dropping SYNs (def: 100)', default=100, type=int)
+    parser.add_argument('--base', help='first fixture port (def: 20000)', default=20000, type=int)
+    parser.add_argument('--scanner', help='socktest.py to benchmark (def: the one next to this script)',
+                        default=os.path.join(here, 'socktest.py'))
+    parser.add_argument('-o', '--output', help='file results are appended to as JSON lines '
+                        '(def: socktest-bench.ndjson)', default='socktest-bench.ndjson')
+    parser.add_argument('--fixtures', help=argparse.SUPPRESS, action='store_true')
+    parser.add_argument('extra', help='further socktest.py arguments, after "--"', nargs='*')
+    args = parser.parse_args()
+
+    limit = raiseFileLimit()
+    if args.fixtures:
+        runFixtures(args.base, args.open, args.refused, args.blackhole)
+        exit(0)
+    if args.open * 2 + args.refused + args.blackhole * 4 + 64 > limit:
+        print('Too many fixture ports for the file descriptor limit of', limit); exit(1)
+
+    fixture = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--fixtures', '--base', str(args.base),
+                                '--open', str(args.open), '--refused', str(args.refused),
+                                '--blackhole', str(args.blackhole)],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        line = fixture.stdout.readline()
+        if not line:
+            print('Fixtures failed to start'); exit(1)
+        ranges = json.loads(line)
+        version = scannerVersion(args.scanner)
+        previous = previousRuns(args.output)
+        print('scanner {}, {} open, {} refused, {} blackhole ports from {}'.format(version, args.open,
+              args.refused, args.blackhole, args.base))
+        print('{:<22s} {:>6s} {:>6s} {:>9s} {:>10s} {:>9s} {:>5s} {:>7s} {:>9s}'.format('spec', 'ports', 'conc',
+              'wall s', 'probes/s', 'rss KiB', 'wrong', 'missing', 'vs prev'))
+        with open(args.output, 'a') as out:
+            for names in args.spec or ['open+refused']:
+                spec, ports = portSpec(ranges, names)
+                for concurrency in args.concurrency or [100]:
+                    best = None
+                    for i in range(args.repeat):
+                        run = runScan(args.scanner, spec, concurrency, args.timeout, args.extra)
+                        if best is None or run[0] < best[0]: best = run
+                    wall, rss, states, code = best
+                    # results for ports that weren't asked for count as wrong too
+                    wrong = sum(1 for port, state in states.items()
+                                if port not in ports or state != expected(ranges, port))
+                    missing = sorted(ports.difference(states))
+                    record = collections.OrderedDict([
+                        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')), ('version', version), ('spec', names),
+                        ('ports', len(ports)), ('results', len(states)), ('concurrency', concurrency),
+                        ('timeout', args.timeout), ('extra', args.extra), ('runs', args.repeat),
+                        ('wall_s', round(wall, 4)), ('probes_per_s', round(len(states) / wall, 1)),
+                        ('maxrss_kib', rss), ('wrong', wrong),
+                        ('missing', len(missing)), ('missing_ports', missing[:100]),
+                        ('counts', collections.Counter(states.values())), ('exit', code)])
+                    key = (names, len(ports), concurrency, tuple(args.extra))
+                    prev = previous.get(key)
+                    delta = '{:+.1f}%'.format((wall / prev['wall_s'] - 1) * 100) if prev else '-'
+                    print('{:<22s} {:>6d} {:>6d} {:>9.3f} {:>10.1f} {:>9d} {:>5d} {:>7d} {:>9s}'.format(names,
+                          len(ports), concurrency, wall, record['probes_per_s'], rss, wrong, len(missing), delta))
+                    out.write(json.dumps(record) + '\n')
+    finally:
+        fixture.stdin.close()
+        fixture.wait()
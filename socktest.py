@@ -1,8 +1,20 @@
 #! /usr/bin/env python3
 
+import os
 import re
+import sys
 import time
 import socket
+import asyncio
+import argparse
+import csv
+import json
+import math
+import errno
+import bisect
+import ipaddress
+import itertools
+import collections
 
 # List of common ports/protocols
 portlist = {
@@ -19,62 +31,657 @@ portlist = {
     2049:  ['nfs'],            2483:  ['ora'],            2484:  ['ora'],
     3389:  ['rdp','ts'],       5900:  ['vnc'],            8080:  ['http','proxy'],
 }
-t= []
-
-def testConnection(rhost, rport):
-    # Test connection
-    if rport in t: return None
-    t.append(rport)
-    if rport in portlist.keys(): name = '('+portlist[rport][0]+')'
-    else: name = ''
-    
+# Defaults for use as a module; replaced by the parsed arguments when run as a script
+args = argparse.Namespace(verbose=False, printopen=False, addresses='first')
+localName = None
+raceDelay = 0.25
+
+# Outcome of one test: state is one of open, refused, timeout, unreachable or error; rtt is in seconds
+Result = collections.namedtuple('Result', ['host', 'port', 'addr', 'state', 'rtt', 'error', 'laddr', 'lport',
+                                           'detected', 'banner'], defaults=(None, None))
+fields = ['host', 'addr', 'port', 'service', 'state', 'rtt_ms', 'error', 'local', 'detected', 'banner']
+
+# Greetings identifying a service, tried in order against the start of what the server sends
+greetings = [
+    (re.compile(rb'SSH-\d'), 'ssh'),
+    (re.compile(rb'HTTP/\d'), 'http'),
+    (re.compile(rb'220[ -].*ftp', re.I), 'ftp'),
+    (re.compile(rb'220[ -]'), 'smtp'),
+    (re.compile(rb'\+OK'), 'pop3'),
+    (re.compile(rb'\* (OK|PREAUTH)'), 'imap'),
+    (re.compile(rb'RFB \d'), 'vnc'),
+    (re.compile(rb'.\0\0\0\x0a[0-9]', re.S), 'mysql'),
+]
+httpProbe = b'HEAD / HTTP/1.0\r\n\r\n'
+
+states = {errno.ECONNREFUSED: 'refused', errno.ETIMEDOUT: 'timeout', errno.EHOSTUNREACH: 'unreachable',
+          errno.ENETUNREACH: 'unreachable', errno.EHOSTDOWN: 'unreachable'}
+
+async def testConnection(rhost, rport, timeout=None, addr=None, banner=None):
+    # Test connection to a resolved (family, sockaddr) address, or to rhost over IPv4 if none is given,
+    # recording the connect round-trip time and local endpoint; with banner=(deadline, cap) the service
+    # greeting of open ports is read and identified
+    loop = asyncio.get_running_loop()
+    if addr is None: family, sockaddr = socket.AF_INET, (rhost, rport)
+    else: family, sockaddr = addr[0], (addr[1][0], rport) + tuple(addr[1][2:])
+    ip = sockaddr[0]
+    s = None
+    start = time.perf_counter()
     try:
-        if not args.printopen: print('trying ', rhost, ':{:<5s} {:<10s}'.format(str(rport), name), ' ... ', sep='', end='')
-        s = socket.socket()
-        s.connect((rhost, rport))
+        s = socket.socket(family, socket.SOCK_STREAM)
+        s.setblocking(False)
+        start = time.perf_counter()
+        await asyncio.wait_for(loop.sock_connect(s, sockaddr), timeout)
+    except asyncio.TimeoutError:
+        return Result(rhost, rport, ip, 'timeout', time.perf_counter() - start, 'timed out', *localEndpoint(s))
     except socket.error as e:
-        if args.verbose:
-            print(e)
-        elif args.printopen:
-            pass
-        else:
-            print('failed')
-        return False
+        rtt = time.perf_counter() - start
+        if e.errno:
+            error = str(socket.error(e.errno, os.strerror(e.errno)))
+            return Result(rhost, rport, ip, states.get(e.errno, 'error'), rtt, error, *localEndpoint(s))
+        return Result(rhost, rport, ip, 'error', rtt, str(e), *localEndpoint(s))
+    else:
+        rtt = time.perf_counter() - start
+        detected = greeting = None
+        if banner: detected, greeting = await readBanner(s, rport, *banner)
+        return Result(rhost, rport, ip, 'open', rtt, None, *localEndpoint(s), detected, greeting)
+    finally:
+        if s is not None: s.close()
+
+async def readBanner(s, rport, deadline, cap):
+    # Reads what the server sends within `deadline` seconds and `cap` bytes, sending an HTTP request if
+    # it is an HTTP port or stays silent for half the deadline; returns the detected service and the
+    # first line received
+    loop = asyncio.get_running_loop()
+    end = time.monotonic() + deadline
+    data = b''
+    sent = False
+    if 'http' in portlist.get(rport, []):
+        try: await loop.sock_sendall(s, httpProbe)
+        except socket.error: return None, None
+        sent = True
+    while len(data) < cap:
+        now = time.monotonic()
+        wait = end - now if sent else min(end - now, deadline / 2)
+        if wait <= 0: break
+        try:
+            chunk = await asyncio.wait_for(loop.sock_recv(s, cap - len(data)), wait)
+        except asyncio.TimeoutError:
+            if sent or data: break
+            try: await loop.sock_sendall(s, httpProbe)
+            except socket.error: break
+            sent = True
+            continue
+        except socket.error:
+            break
+        if not chunk: break
+        data += chunk
+        if b'\n' in data and not data.startswith(b'HTTP/'): break
+        if b'\r\n\r\n' in data: break
+    if not data: return None, None
+    detected = next((name for pattern, name in greetings if pattern.match(data)), None)
+    lines = data.decode('latin-1').splitlines()
+    line = ''.join(c if c.isprintable() else '.' for c in lines[0].strip()) if lines else ''
+    if detected == 'http':
+        server = [l.split(':', 1)[1].strip() for l in lines if l.lower().startswith('server:')]
+        if server: line = '{} ({})'.format(line, server[0])
+    return detected, line
+
+async def raceConnection(rhost, rport, addrs, timeout=None, delay=raceDelay, banner=None):
+    # Happy eyeballs: start a connection to each address in turn, `delay` seconds apart or as soon as the
+    # previous one fails, keeping the first to connect
+    pending = set()
+    addrs = list(addrs)
+    result = None
+    try:
+        while addrs or pending:
+            if addrs:
+                pending.add(asyncio.ensure_future(testConnection(rhost, rport, timeout, addrs.pop(0), banner)))
+            done, pending = await asyncio.wait(pending, timeout=delay if addrs else None,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.result().state == 'open': return task.result()
+                result = task.result()
+        return result
+    finally:
+        for task in pending: task.cancel()
+
+def interleave(addrs):
+    # Alternates address families, starting with the preferred (first) one
+    families = collections.OrderedDict()
+    for addr in addrs: families.setdefault(addr[0], []).append(addr)
+    return [a for group in itertools.zip_longest(*families.values()) for a in group if a is not None]
+
+def isAddress(host):
+    try: ipaddress.ip_address(host)
+    except ValueError: return False
+    return True
+
+def addressList(host, family=socket.AF_UNSPEC):
+    # Resolves a host to a list of unique (family, sockaddr) addresses, skipping DNS for IP literals
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        addrs = []
+        for fam, kind, proto, canon, sockaddr in socket.getaddrinfo(host, None, family, socket.SOCK_STREAM):
+            if (fam, sockaddr) not in addrs: addrs.append((fam, sockaddr))
+        return addrs
+    fam = socket.AF_INET if ip.version == 4 else socket.AF_INET6
+    if family not in (socket.AF_UNSPEC, fam):
+        raise socket.gaierror(socket.EAI_ADDRFAMILY, 'Address family for hostname not supported')
+    return [(fam, (str(ip), 0) if ip.version == 4 else (str(ip), 0, 0, 0))]
+
+class Resolver:
+    # Resolves each host once, sharing the addresses (or the error) between every test of the host
+    def __init__(self, family=socket.AF_UNSPEC):
+        self.family = family
+        self.cache = {}
+
+    def lookup(self, host):
+        # Addresses of a host, or why it can't be resolved; overlong labels raise UnicodeError
+        try: return addressList(host, self.family)
+        except (socket.error, UnicodeError) as e: return str(e)
+
+    def resolve(self, host):
+        if host not in self.cache: self.cache[host] = self.lookup(host)
+        return self.cache[host]
+
+    async def resolveAsync(self, host):
+        # IP addresses are resolved inline, names by the loop's executor so lookups overlap; the cache holds
+        # the pending lookup until it completes so concurrent callers share it
+        if host not in self.cache and isAddress(host): return self.resolve(host)
+        if host not in self.cache:
+            self.cache[host] = asyncio.get_running_loop().run_in_executor(None, self.lookup, host)
+        cached = self.cache[host]
+        if isinstance(cached, asyncio.Future):
+            cached = await asyncio.shield(cached)
+            self.cache[host] = cached
+        return cached
+
+def localEndpoint(s):
+    if s is None: return (None, None)
+    try: return s.getsockname()[:2]
+    except socket.error: return (None, None)
+
+def serviceName(rport):
+    if rport in portlist.keys(): return portlist[rport][0]
+    return ''
+
+def hostName():
+    global localName
+    if localName is None: localName = socket.gethostname()
+    return localName
+
+def printResult(result):
+    rhost, rport = result.host, result.port
+    if args.addresses == 'all' and result.addr and result.addr != rhost: rhost = '{}[{}]'.format(rhost, result.addr)
+    name = serviceName(rport)
+    if name: name = '('+name+')'
+    connected = result.state == 'open'
+    if args.printopen and not connected: return
+    print('trying ', rhost, ':{:<5s} {:<10s}'.format(str(rport), name), ' ... ', sep='', end='')
+    if not connected:
+        if args.verbose: print(result.error)
+        else: print('failed')
+        return
+    lhost = hostName()
+    if result.detected or result.banner:
+        print('connected', '[{}]'.format(result.detected or '?'), result.banner or '')
     else:
-        if args.printopen: print('trying ', rhost, ':{:<5s} {:<10s}'.format(str(rport), name), ' ... ', sep='', end='')
-        lhost = socket.gethostname()
-        lport = str(s.getsockname()[1])
         print('connected')
-        if args.verbose:
-            print('   {', '<->'.join([':'.join([lhost, str(lport)]), ':'.join([rhost, str(rport)])]), '}', sep='')
-        s.close()
-        return True
+    if args.verbose:
+        print('   {', '<->'.join([':'.join([lhost, str(result.lport)]), ':'.join([rhost, str(rport)])]), '}', sep='')
+
+def resultRecord(result):
+    local = None if result.laddr is None else '{}:{}'.format(result.laddr, result.lport)
+    return dict(zip(fields, [result.host, result.addr, result.port, serviceName(result.port), result.state,
+                             round(result.rtt * 1000, 3), result.error, local, result.detected, result.banner]))
+
+def printJson(result):
+    if args.printopen and result.state != 'open': return
+    print(json.dumps(resultRecord(result)))
+
+class CsvWriter:
+    # Writes results as CSV rows after a header
+    def __init__(self, stream=None):
+        self.writer = csv.DictWriter(stream or sys.stdout, fields)
+        self.writer.writeheader()
+
+    def __call__(self, result):
+        if args.printopen and result.state != 'open': return
+        self.writer.writerow(resultRecord(result))
+
+class Histogram:
+    # Approximate latency distribution using logarithmic buckets 5% wide, so memory use is fixed
+    base = 1e-5
+    width = math.log(1.05)
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.n = 0
+
+    def add(self, value):
+        self.counts[max(0, int(math.log(max(value, self.base) / self.base) / self.width))] += 1
+        self.n += 1
+
+    def percentile(self, p):
+        if self.n == 0: return None
+        rank = max(1, math.ceil(self.n * p / 100.0))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank: return self.base * math.exp((bucket + 1) * self.width)
+
+class TokenBucket:
+    # Allows `rate` connections per second on average, in bursts of up to `burst`
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def wait(self, now):
+        # Seconds until a token is available
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1: return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class Host:
+    # Scheduling state of one target host; tests start once its addresses are known
+    def __init__(self, host, ports, bucket=None, mode='first'):
+        self.host = host
+        self.ports = ports
+        self.bucket = bucket
+        self.mode = mode
+        self.tests = None
+        self.retries = collections.deque()
+        self.inflight = 0
+        self.exhausted = False
+        self.srtt = self.rttvar = None
+
+    def sample(self, rtt):
+        # Updates the smoothed round-trip time and its variation the way TCP does (RFC 6298)
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeout(self, initial, minimum=None, attempt=0):
+        # Connect timeout for a test: `initial` until a round-trip time has been measured (or when not
+        # adapting), then derived from it and bounded by `minimum` and `initial`; doubled for each retry
+        t = initial
+        if minimum is not None and self.srtt is not None: t = max(minimum, self.srtt + 4 * self.rttvar)
+        if t is not None: t *= 2 ** attempt
+        if initial is not None and t is not None: t = min(t, initial)
+        return t
+
+    def setAddresses(self, addrs):
+        # Sets the resolved addresses, or an error message, making the tests of the host available as
+        # (addresses to try, port) pairs
+        if isinstance(addrs, str) or len(addrs) == 0:
+            self.error = addrs or 'No addresses found'
+            self.tests = ((None, p) for p in self.ports)
+        elif self.mode == 'all':
+            self.tests = (([a], p) for p in self.ports for a in addrs)
+        elif self.mode == 'race':
+            addrs = interleave(addrs)
+            self.tests = ((addrs, p) for p in self.ports)
+        else:
+            self.tests = ((addrs[:1], p) for p in self.ports)
+
+async def scanTargets(targets, limit=100, hostLimit=10, timeout=None, rate=None, hostRate=None, burst=1,
+                      family=socket.AF_UNSPEC, mode='first', minTimeout=None, retries=0, banner=None,
+                      report=printResult):
+    # Tests (host, ports[, addresses]) targets, interleaving hosts round-robin with at most `limit`
+    # connections in progress overall and `hostLimit` per host, starting at most `rate` connections per
+    # second overall and `hostRate` per host; results are reported in the order tests were started.
+    # Hosts are resolved once, testing the first, all, or racing the addresses found depending on `mode`.
+    # With `minTimeout` the timeout of each host adapts to its round-trip time, `timeout` being the
+    # initial and maximum value; tests that time out are retried up to `retries` times. With
+    # banner=(deadline, cap) open ports are asked what service they run
+    bucket = TokenBucket(rate, burst) if rate else None
+    resolver = Resolver(family)
+    targets = iter(targets)
+    active = collections.deque()
+    maxActive = 2 * max(1, -(-limit // hostLimit))   # enough hosts to fill `limit` when some are slow
+    done = asyncio.Queue()
+    tasks = set()
+    results = {}
+    inflight = seq = nxt = resolving = 0
+
+    async def resolve(h):
+        try:
+            try: h.setAddresses(await resolver.resolveAsync(h.host))
+            except Exception as e: h.setAddresses(str(e) or repr(e))
+        finally:
+            # always wake the scheduler, or it would wait for this host forever
+            await done.put(None)
+
+    def fill():
+        nonlocal resolving
+        added = False
+        while len(active) < maxActive:
+            try: target = next(targets)
+            except StopIteration: break
+            h = Host(target[0], target[1], TokenBucket(hostRate, burst) if hostRate else None, mode)
+            if len(target) > 2:
+                h.setAddresses(target[2])
+            else:
+                resolving += 1
+                task = asyncio.ensure_future(resolve(h))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            active.append(h)
+            added = True
+        return added
+
+    def prune():
+        finished = [h for h in active if h.exhausted and h.inflight == 0 and not h.retries]
+        for h in finished: active.remove(h)
+        return len(finished) > 0
+
+    def pick(now):
+        # Returns the next host ready for a test and its (sequence, test, attempt), retries first, or the
+        # time until a rate limited host is ready
+        wake = None
+        for i in range(len(active)):
+            h = active[0]
+            active.rotate(-1)
+            if (h.exhausted and not h.retries) or h.tests is None or h.inflight >= hostLimit: continue
+            if h.bucket:
+                w = h.bucket.wait(now)
+                if w > 0:
+                    wake = w if wake is None else min(wake, w)
+                    continue
+            if h.retries: return h, h.retries.popleft(), None
+            test = next(h.tests, None)
+            if test is not None: return h, (None, test, 0), None
+            h.exhausted = True
+        return None, None, wake
+
+    async def probe(h, i, test, attempt):
+        addrs, port = test
+        wait = h.timeout(timeout, minTimeout, attempt)
+        try:
+            if addrs is None: result = Result(h.host, port, None, 'error', 0.0, h.error, None, None)
+            elif len(addrs) == 1: result = await testConnection(h.host, port, wait, addrs[0], banner)
+            else: result = await raceConnection(h.host, port, addrs, wait, banner=banner)
+        except Exception as e:
+            # always report back, or the scheduler would wait for this test forever
+            result = Result(h.host, port, None, 'error', 0.0, str(e) or repr(e), None, None)
+        await done.put((h, (i, test, attempt), result))
+
+    while True:
+        wake = None
+        while inflight < limit:
+            now = time.monotonic()
+            if bucket:
+                wake = bucket.wait(now) or None
+                if wake: break
+            h, item, wake = pick(now)
+            if h is None:
+                if prune() | fill(): continue
+                break
+            if bucket: bucket.take()
+            if h.bucket: h.bucket.take()
+            i, test, attempt = item
+            if i is None:
+                i = seq
+                seq += 1
+            task = asyncio.ensure_future(probe(h, i, test, attempt))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            h.inflight += 1
+            inflight += 1
+        if inflight == 0 and resolving == 0 and wake is None: break
+        try:
+            item = await asyncio.wait_for(done.get(), wake)
+        except asyncio.TimeoutError:
+            continue
+        if item is None:
+            # a host has been resolved
+            resolving -= 1
+            continue
+        h, (i, test, attempt), result = item
+        h.inflight -= 1
+        inflight -= 1
+        if result.state in ('open', 'refused'): h.sample(result.rtt)
+        if result.state == 'timeout' and attempt < retries:
+            h.retries.append((i, test, attempt + 1))
+            continue
+        results[i] = result
+        while nxt in results:
+            report(results.pop(nxt))
+            nxt += 1
+
+class Summary:
+    # Reports results while counting outcomes and connect latencies per host
+    def __init__(self, report=printResult):
+        self.report = report
+        self.hosts = collections.OrderedDict()
+
+    def __call__(self, result):
+        self.report(result)
+        if result.host not in self.hosts: self.hosts[result.host] = (collections.Counter(), Histogram())
+        counts, latency = self.hosts[result.host]
+        counts[result.state] += 1
+        if result.state in ('open', 'refused'): latency.add(result.rtt)
+
+    def records(self):
+        for host, (counts, latency) in self.hosts.items():
+            record = collections.OrderedDict(type='summary', host=host, tested=sum(counts.values()))
+            for state in ('open', 'refused', 'timeout', 'unreachable', 'error'): record[state] = counts[state]
+            for p in (50, 90, 99):
+                value = latency.percentile(p)
+                record['p%d_ms' % p] = None if value is None else round(value * 1000, 3)
+            yield record
+
+    def printSummary(self, fmt='text'):
+        total = collections.Counter()
+        out = sys.stdout if fmt == 'text' else sys.stderr
+        for record in self.records():
+            if fmt == 'ndjson':
+                print(json.dumps(record))
+                continue
+            total.update(tested=record['tested'], open=record['open'], closed=record['tested'] - record['open'])
+            line = '{}: {} tested, {} open, {} closed'.format(record['host'], record['tested'], record['open'],
+                                                            record['tested'] - record['open'])
+            if record['p50_ms'] is not None:
+                line += ', connect p50/p90/p99 {p50_ms:.3f}/{p90_ms:.3f}/{p99_ms:.3f} ms'.format(**record)
+            print(line, file=out)
+        if fmt != 'ndjson' and len(self.hosts) != 1:
+            print('{} hosts: {} tested, {} open, {} closed'.format(len(self.hosts), total['tested'], total['open'],
+                                                                 total['closed']), file=out)
+
+def chunkTargets(targets, size):
+    # Splits (host, ports[, addresses]) targets into lists of targets testing about `size` ports in total
+    chunk = []
+    n = 0
+    for target in targets:
+        host, ports = target[:2]
+        for i in range(0, len(ports), size):
+            part = ports[i:i + size]
+            chunk.append((host, part) + tuple(target[2:]))
+            n += len(part)
+            if n >= size:
+                yield chunk
+                chunk = []
+                n = 0
+    if chunk: yield chunk
+
+def scanChunk(chunk, options):
+    # Runs one chunk of targets in its own event loop, returning results ordered by target and port
+    results = []
+    asyncio.run(scanTargets(chunk, *options, report=results.append))
+    order = {}
+    for i, target in enumerate(chunk): order.setdefault(target[0], i)
+    results.sort(key=lambda r: (order[r.host], r.port, r.addr or ''))
+    return results
+
+def scanWorkers(targets, workers, limit=100, hostLimit=10, timeout=None, rate=None, hostRate=None, burst=1,
+                family=socket.AF_UNSPEC, mode='first', minTimeout=None, retries=0, banner=None,
+                report=printResult, chunkSize=1024):
+    # Shards targets into chunks scanned by `workers` processes; the limits are split between them, rounding
+    # down, with no more workers than the concurrency limits can be split between. The burst is split too but
+    # is at least one per worker. Results are reported in target order as chunks complete. Hosts are resolved
+    # here, once, rather than by each worker
+    from concurrent.futures import ProcessPoolExecutor
+    workers = max(1, min(workers, limit or workers, hostLimit or workers))
+    share = lambda n: n and max(1, n // workers)
+    options = (share(limit), share(hostLimit), timeout, rate and rate / workers, hostRate and hostRate / workers,
+               share(burst), family, mode, minTimeout, retries, banner)
+    resolver = Resolver(family)
+    targets = ((host, ports, resolver.resolve(host)) for host, ports in targets)
+    pending = collections.deque()
+    with ProcessPoolExecutor(workers) as executor:
+        for chunk in chunkTargets(targets, chunkSize):
+            pending.append(executor.submit(scanChunk, chunk, options))
+            while len(pending) > 2 * workers:
+                for r in pending.popleft().result(): report(r)
+        while pending:
+            for r in pending.popleft().result(): report(r)
+
+async def scanPorts(rhost, ports, limit=100, timeout=None, rate=None, burst=1, report=printResult):
+    # Tests up to `limit` ports of a single host at once
+    await scanTargets([(rhost, ports)], limit, limit, timeout, rate, None, burst, report=report)
+
+class PortSet:
+    # Sorted set of ports stored as merged, inclusive (low, high) ranges; membership is a binary search,
+    # iteration and slicing are lazy, so memory does not depend on the size of the ranges
+    def __init__(self, ranges=()):
+        self.ranges = []
+        for lo, hi in ranges: self.add(lo, hi)
+
+    def add(self, lo, hi=None):
+        hi = lo if hi is None else hi
+        i = bisect.bisect_left(self.ranges, (lo, lo))
+        if i and self.ranges[i - 1][1] >= lo - 1: i -= 1
+        j = i
+        while j < len(self.ranges) and self.ranges[j][0] <= hi + 1:
+            lo, hi = min(lo, self.ranges[j][0]), max(hi, self.ranges[j][1])
+            j += 1
+        self.ranges[i:j] = [(lo, hi)]
+
+    def remove(self, lo, hi=None):
+        hi = lo if hi is None else hi
+        kept = []
+        for a, b in self.ranges:
+            if b < lo or a > hi: kept.append((a, b)); continue
+            if a < lo: kept.append((a, lo - 1))
+            if b > hi: kept.append((hi + 1, b))
+        self.ranges = kept
+
+    def __contains__(self, port):
+        i = bisect.bisect_right(self.ranges, (port, float('inf')))
+        return i > 0 and self.ranges[i - 1][1] >= port
+
+    def __iter__(self):
+        for lo, hi in self.ranges: yield from range(lo, hi + 1)
+
+    def __len__(self):
+        return sum(hi - lo + 1 for lo, hi in self.ranges)
+
+    def __getitem__(self, s):
+        # Only slices are supported, returning the ports from position s.start to s.stop as a PortSet
+        start, stop, step = s.indices(len(self))
+        part = PortSet()
+        if stop <= start: return part
+        for lo, hi in self.ranges:
+            n = hi - lo + 1
+            if start < n and stop > 0: part.ranges.append((lo + max(start, 0), lo + min(stop, n) - 1))
+            start -= n; stop -= n
+        return part
+
+    def __eq__(self, other):
+        return isinstance(other, PortSet) and self.ranges == other.ranges
+
+    def __repr__(self):
+        return 'PortSet({})'.format(','.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in self.ranges))
+
+def parsePorts(dport):
+    # Parses a comma separated port specification into a PortSet; `!<spec>` entries are excluded
+    ports = PortSet()
+    excluded = []
+    for a in dport.split(','):
+        if a.startswith('!'): excluded.extend(checkPort(a[1:]))
+        else:
+            for lo, hi in checkPort(a): ports.add(lo, hi)
+    for lo, hi in excluded: ports.remove(lo, hi)
+    return ports
+
+def splitTarget(spec):
+    # Splits `<host>:<port>`, `[<IPv6 address>]:<port>` or a bare host into host and port specification
+    if spec.startswith('['):
+        host, sep, rest = spec[1:].partition(']')
+        if not sep or (rest and not rest.startswith(':')): return None, None
+        return host, rest[1:] or None
+    if spec.count(':') > 1: return spec, None   # bare IPv6 address
+    host, sep, dport = spec.rpartition(':')
+    if not sep: return spec, None
+    return host, dport
+
+def expandTargets(specs, defaultPorts=None):
+    # Yields (host, ports) for each `<host>[:<port>]` spec; hosts may be CIDR ranges
+    parsed = {}
+    for spec in specs:
+        host, dport = splitTarget(spec)
+        if dport is None: dport = defaultPorts
+        if not host or not dport:
+            print('No ports given for target:', spec)
+            parser.print_help(); exit(2)
+        if dport not in parsed:
+            parsed[dport] = parsePorts(dport)
+            if len(parsed[dport]) == 0:
+                print('Unable to decypher port specifications!')
+                parser.print_help(); exit(3)
+        if '/' in host:
+            try: network = ipaddress.ip_network(host, strict=False)
+            except ValueError:
+                print('Invalid network:', host)
+                parser.print_help(); exit(2)
+            hosts = network.hosts() if network.num_addresses > 2 else iter(network)
+            for h in hosts: yield str(h), parsed[dport]
+        else:
+            yield host, parsed[dport]
+
+def readTargets(files):
+    # Yields target specs from host files, one per line; '#' starts a comment
+    for name in files:
+        with open(name) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line: yield line
 
 def checkPort(n):
+    # Returns the (low, high) port ranges of a single port specification
     l = []
     if n.isdigit():
-        l.append(int(n))
+        l.append((int(n), int(n)))
     elif n.__contains__('-'):
-        x = [int(y) for y in n.split('-')]
-        if x[0] > x[1]:
+        try: x = [int(y) for y in n.split('-')]
+        except ValueError: x = []
+        if len(x) != 2 or x[0] > x[1]:
             print('Invalid range given! Use `<hostname>:<x>-<y>` where <x>\nand <y> are numeric and <y> is greater than <x>')
             exit(1)
-        y = range(x[0], x[1])
-        for z in y:
-            l.append(z)
-        l.append(x[1])
+        l.append((x[0], x[1]))
     elif n.lower() == 'all':
-        l = list(portlist.keys())
+        l = [(k, k) for k in portlist.keys()]
     elif n.isalnum():
-        x = [int(k) for k,v in portlist.items() if v.__contains__(n.lower())]
-        if len(x) < 1:
+        l = [(int(k), int(k)) for k,v in portlist.items() if v.__contains__(n.lower())]
+        if len(l) < 1:
             print('Port name', n, 'not known!')
             parser.print_help(); exit(1)
-        for z in x:
-            l.append(z)
     else:
         print('Invalid port specification:', n)
         parser.print_help(); exit(1)
+    if any(hi > 65535 for lo, hi in l):
+        print('Port out of range:', n)
+        parser.print_help(); exit(1)
     return l
 
 def printList():
@@ -92,7 +699,6 @@ def printList():
 
 if __name__ == '__main__':
     # Get arguments
-    import argparse
     parser = argparse.ArgumentParser(description='Checks availability of remote ports',
                      epilog='Use special keyword "all" for <port> to test all common port numbers')
     args = [('-v', '--verbose', 'output error messages', dict(action='store_true')                   ),
@@ -100,8 +706,37 @@ if __name__ == '__main__':
         ('-o', '--open',    'only show open ports',  dict(action='store_true', dest='printopen') )]
     for arg1, arg2, arghelp, options in args:
         parser.add_argument(arg1, arg2, help=arghelp, **options)
-    parser.add_argument('target', help='remote target', metavar='<hostname>:<port>', nargs='?', default=None)
-    parser.add_argument('delay', help='delay between tests in seconds (def: 0)', nargs='?', default=0, type=int)
+    parser.add_argument('target', help='remote targets, <hostname> may be a CIDR range; a trailing number is '
+                        'taken as the delay between tests in seconds, same as --rate 1/<delay>',
+                        metavar='<hostname>:<port>', nargs='*')
+    parser.add_argument('-f', '--file', help='read targets from FILE, one per line', action='append', default=[])
+    parser.add_argument('-p', '--ports', help='ports for targets given without them', metavar='<port>')
+    parser.add_argument('-c', '--concurrency', help='max connections in progress (def: 100)', default=100, type=int)
+    parser.add_argument('--host-limit', help='max connections in progress per host (def: 10)', default=10, type=int)
+    parser.add_argument('-t', '--timeout', help='connect timeout in seconds (def: 3)', default=3.0, type=float)
+    parser.add_argument('-m', '--min-timeout', help='adapt the timeout of each host to its round-trip time, down to '
+                        'MIN_TIMEOUT seconds; --timeout is then the initial and maximum timeout', type=float)
+    parser.add_argument('--retries', help='times to retry a test that timed out (def: 0)', default=0, type=int)
+    parser.add_argument('-r', '--rate', help='max connections started per second (def: unlimited)', type=float)
+    parser.add_argument('--host-rate', help='max connections started per second per host (def: unlimited)',
+                        type=float)
+    parser.add_argument('-b', '--burst', help='connections allowed at once before --rate and --host-rate apply '
+                        '(def: 1)', default=1, type=int)
+    parser.add_argument('-w', '--workers', help='scan with up to N processes, splitting the limits between them '
+                        '(def: 1)', default=1, type=int, metavar='N')
+    parser.add_argument('--banner', help='read the greeting of open ports, or send an HTTP request, for up to '
+                        'SECONDS to detect the service (def: 2)', metavar='SECONDS', nargs='?', const=2.0, type=float)
+    parser.add_argument('--banner-bytes', help='max bytes of a greeting to read (def: 256)', default=256, type=int)
+    parser.add_argument('-s', '--summary', help='print a summary of results and connect latency per host',
+                        action='store_true')
+    parser.add_argument('--format', help='output format (def: text)', choices=['text', 'ndjson', 'csv'],
+                        default='text')
+    parser.add_argument('-4', help='only use IPv4 addresses', action='store_const', dest='family',
+                        const=socket.AF_INET, default=socket.AF_UNSPEC)
+    parser.add_argument('-6', help='only use IPv6 addresses', action='store_const', dest='family',
+                        const=socket.AF_INET6)
+    parser.add_argument('-a', '--addresses', help='test the first address a host resolves to, all of them, or race '
+                        'them happy eyeballs style (def: first)', choices=['first', 'all', 'race'], default='first')
     args = parser.parse_args()
     
     # initial checks
@@ -110,38 +745,37 @@ if __name__ == '__main__':
         parser.print_usage()
         exit(1)
     if args.printlist: printList()
-    if args.target == None:
+    if args.target and re.match(r'^\d+(\.\d+)?$', args.target[-1]):
+        delay = float(args.target.pop())
+        if delay > 0 and args.rate is None: args.rate = 1 / delay
+    if not args.target and not args.file:
         if not args.printlist: parser.print_usage()
         exit(2)
 
+    if args.concurrency < 1 or args.host_limit < 1 or args.timeout <= 0 or args.burst < 1 or args.workers < 1 or \
+            (args.rate is not None and args.rate <= 0) or (args.host_rate is not None and args.host_rate <= 0):
+        print('Concurrency, host limit, timeout, rates, burst and workers must be positive')
+        parser.print_usage(); exit(1)
+
     # Main tests
-    try:
-        host, dport = args.target.split(':')
-    except:
-        parser.print_help(); exit(2)
+    targets = expandTargets(itertools.chain(args.target, readTargets(args.file)), args.ports)
 
-    if dport.__contains__(','):
-        dport = dport.split(',')
-    
-    port = []
-    if type(dport) is type('string'):
-        port = checkPort(dport)
-    else:   #if list
-        for a in dport:
-            r = checkPort(a)
-            for b in r:
-                port.append(b)
-    
-    port.sort()
-    if len(port) == 0:
-        print('Unable to decypher port specifications!')
-        parser.print_help(); exit(3)
+    if args.format == 'ndjson': summary = Summary(printJson)
+    elif args.format == 'csv': summary = Summary(CsvWriter())
+    else: summary = Summary()
+    limits = (args.concurrency, args.host_limit, args.timeout, args.rate, args.host_rate, args.burst, args.family,
+              args.addresses, args.min_timeout, args.retries, args.banner and (args.banner, args.banner_bytes))
 
-    for p in port:
-        try:
-            time.sleep(args.delay)
-            testConnection(host, p)
-        except KeyboardInterrupt:
-            print()
-            print('User cancelled')
-            exit()
+    try:
+        if args.workers > 1:
+            scanWorkers(targets, args.workers, *limits, report=summary)
+        else:
+            asyncio.run(scanTargets(targets, *limits, report=summary))
+        if args.summary: summary.printSummary(args.format)
+    except KeyboardInterrupt:
+        print()
+        print('User cancelled')
+        exit()
+    except OSError as e:
+        print(e)
+        exit(2)